@@ -20,3 +20,11 @@ augroup AerojumpBufSettings
   au Filetype *.aerojump setlocal nolist
 augroup END
 
+" Records the file of a buffer as it is read or written so that aerojump only
+" reads the lines from the file while it still matches the buffer
+augroup AerojumpFileStat
+  au!
+  au BufReadPost,BufWritePost * call setbufvar(str2nr(expand('<abuf>')),
+        \ 'aerojump_file_stat', [expand('<afile>:p'),
+        \ getftime(expand('<afile>:p')), getfsize(expand('<afile>:p'))])
+augroup END
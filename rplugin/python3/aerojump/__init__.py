@@ -4,10 +4,42 @@
 # License: MIT license
 # ============================================================================
 
+import codecs
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
 import neovim
 
 from aerojump.aerojump import Aerojump, AerojumpSpace, AerojumpBolt, \
-    AerojumpMilk
+    AerojumpMilk, AerojumpCache, AerojumpSnapshot, DEFAULT_SETTINGS
+
+
+# Buffer info needed to read the lines of a buffer from its file
+FILE_INFO_EXPR = ('[&modified, &buftype, expand("%:p"), &fileencoding, '
+                  '&encoding, &fileformat, &bomb, line("$"), '
+                  'getline(1), getline("$"), get(b:, "aerojump_file_stat"), '
+                  'getftime(expand("%:p")), getfsize(expand("%:p"))]')
+
+
+# Replaces the highlights of a source in a buffer, the same
+# way as pynvim's update_highlights but as an API call that
+# can be batched. A highlight can also cover a range of whole
+# lines, (hl_group, (first_line, last_line))
+UPDATE_HIGHLIGHTS_LUA = """
+local buffer, src_id, highlights = ...
+vim.api.nvim_buf_clear_namespace(buffer, src_id, 0, -1)
+for _, hl in ipairs(highlights) do
+    if type(hl[2]) == 'table' then
+        vim.api.nvim_buf_set_extmark(buffer, src_id, hl[2][1], 0, {
+            end_row = hl[2][2] + 1, end_col = 0, hl_group = hl[1]})
+    else
+        vim.api.nvim_buf_add_highlight(
+            buffer, src_id, hl[1], hl[2], hl[3] or 0, hl[4] or -1)
+    end
+end
+"""
 
 
 def get_output_of_vim_cmd(nvim, cmd):
@@ -27,6 +59,44 @@ def get_output_of_vim_cmd(nvim, cmd):
     return nvim.eval('@a').strip('\n')
 
 
+def read_buffer_file(path, encoding, fileformat, bomb):
+    """ Utility function to read the lines of a file
+        the way Neovim loads them
+
+    Parameters:
+        path: Path of the file
+        encoding: 'fileencoding' of the buffer
+        fileformat: 'fileformat' of the buffer
+        bomb: 'bomb' of the buffer
+
+    Returns:
+        List of the lines or None if the file can't be read that way
+    """
+    separator = {'unix': '\n', 'dos': '\r\n', 'mac': '\r'}.get(fileformat)
+    if separator is None or not os.path.isfile(path):
+        return None
+    try:
+        codec = codecs.lookup(encoding).name
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ['']
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                text = str(data, codec)
+    except (OSError, ValueError, LookupError):
+        return None
+
+    if bomb and text.startswith('\ufeff'):
+        text = text[1:]
+    if '\x00' in text:
+        # Neovim has NUL as newline in the lines
+        return None
+    lines = text.split(separator)
+    if len(lines) > 1 and lines[-1] == '':
+        # The last line ends with a separator too
+        lines.pop()
+    return lines
+
+
 @neovim.plugin
 class AerojumpNeovim(object):
     def __init__(self, nvim):
@@ -34,6 +104,41 @@ class AerojumpNeovim(object):
         self.logstr = []
         self.logstr.append('== Aerojump debug ==')
         self.has_searched = False
+        self.aj = None
+        # Incremented for every new filter so that stale
+        # continuations of older filters can be ignored
+        self.filter_generation = 0
+        # Async filtering, the lock guards the aerojump object
+        # since it's shared with the filter thread
+        self.use_async = False
+        self.engine_lock = threading.Lock()
+        self.filter_timer = None
+        # Lines of recently searched buffers by buffer number,
+        # bounded by the snapshot settings of the latest session
+        self.snapshots = AerojumpCache(0, 0)
+        # Buffers whose lines are kept up to date from their change
+        # events, buffer number -> [buffer, changedtick, snapshot,
+        # changes, changes_size], the changes are queued until the
+        # snapshot is needed, changes_size counts them and their lines
+        self.mirrors = OrderedDict()
+        # The changedtick of the snapshot that the aerojump
+        # object was created from
+        self.aj_changedtick = None
+        # Overlay mode draws on the original buffer, folds hide the
+        # lines without hits in space mode
+        self.use_overlay = False
+        self.use_folds = False
+        # The fold options of the aerojump window are kept in
+        # w:aerojump_folds while the folds are in use
+        self.fold_options = ('&l:foldmethod', '&l:foldenable',
+                             '&l:foldlevel', '&l:foldminlines')
+        self.hl_source = None
+        self.cursor_hl_source = None
+        # Keymap commands are only rebuilt when g:aerojump_keymaps changes
+        self.keymaps = None
+        self.keymap_calls = []
+        # Every update is sent as one batch, these count them
+        self.update_stats = {'updates': 0, 'calls': 0, 'max_calls': 0}
         self.default_keymaps = {
             "<C-p>": "AerojumpUp",
             "<Left>": "AerojumpSelPrev",
@@ -54,43 +159,306 @@ class AerojumpNeovim(object):
     def __log(self, s):
         self.logstr.append(str(s))
 
-    def __open_aerojump_buf(self):
-        self.nvim.command('silent split Aerojump')
-        self.nvim.command('silent setlocal buftype=nofile')
-        self.nvim.command('silent setlocal filetype=aerojump')
-        # Fix filetype in order to keep old syntax
-        self.nvim.command('silent set filetype='+self.ft+'.aerojump')
-        self.aerojump_buf_num = self.nvim.current.buffer.number
+    def __call_atomic(self, calls):
+        """ Makes several API calls in one round trip
+
+        Parameters:
+            calls: List of [method, args]
+
+        Returns:
+            List of the results of the calls
+        """
+        results, error = self.nvim.api.call_atomic(calls)
+        if error is not None:
+            # error is [index, type, message]
+            raise neovim.NvimError(error[2])
+        return results
+
+    def __open_aerojump_buf(self, calls):
+        """ Adds the calls that open the aerojump buffer
+
+        Parameters:
+            calls: List of calls to add to
+
+        Returns:
+            n/a
+        """
+        calls += [
+            ['nvim_command', ['silent split Aerojump']],
+            ['nvim_command', ['silent setlocal buftype=nofile']],
+            ['nvim_command', ['silent setlocal filetype=aerojump']],
+            # Fix filetype in order to keep old syntax
+            ['nvim_command', ['silent set filetype='+self.ft+'.aerojump']],
+        ]
+
+    def __open_aerojump_overlay(self, calls):
+        """ Adds the calls that open the original buffer in the
+            aerojump window, the results are drawn on it without
+            changing its lines
+
+        Parameters:
+            calls: List of calls to add to
+
+        Returns:
+            n/a
+        """
+        calls += [
+            ['nvim_command', ['silent split']],
+            ['nvim_set_current_buf', [self.og_buf]],
+        ]
+        self.folded_ranges = []
+        if self.use_folds:
+            calls += [
+                ['nvim_command', ['let w:aerojump_folds = [%s]'
+                                  % ', '.join(self.fold_options)]],
+                ['nvim_command', ['setlocal foldmethod=manual foldenable '
+                                  'foldlevel=0 foldminlines=0']],
+            ]
+
+    def __close_aerojump_overlay(self, calls):
+        """ Adds the calls that clear what has been drawn on the
+            original buffer in the aerojump window
+
+        Parameters:
+            calls: List of calls to add to
+
+        Returns:
+            n/a
+        """
+        calls += [
+            ['nvim_buf_clear_namespace', [self.og_buf, self.hl_source, 0, -1]],
+            ['nvim_buf_clear_namespace',
+             [self.og_buf, self.cursor_hl_source, 0, -1]],
+        ]
+        if self.use_folds:
+            # Restored so that later windows of the buffer don't
+            # start out with the fold options of the aerojump window
+            commands = ['silent! normal! zE',
+                        'let [%s] = w:aerojump_folds'
+                        % ', '.join(self.fold_options),
+                        'unlet w:aerojump_folds']
+            calls.append(['nvim_call_function',
+                          ['win_execute', [self.main_win.handle, commands]]])
+
+    def __fold_lines(self, calls, ranges):
+        """ Adds the calls that fold away lines in the aerojump window
 
-    def __open_aerojump_filter_buf(self, filter_string=''):
+        Parameters:
+            calls:  List of calls to add to
+            ranges: List of (first_line, last_line) to fold
+
+        Returns:
+            n/a
+        """
+        if ranges == self.folded_ranges:
+            return
+        self.folded_ranges = ranges
+        commands = ['silent! normal! zE']
+        if ranges != []:
+            commands.append(' | '.join('%d,%dfold' % r for r in ranges))
+        calls.append(['nvim_call_function',
+                      ['win_execute', [self.main_win.handle, commands]]])
+
+    def __open_aerojump_filter_buf(self, calls, filter_string=''):
+        """ Adds the calls that open the filter buffer with its keymaps
+
+        Parameters:
+            calls:          List of calls to add to
+            filter_string:  Initial content of the filter buffer
+
+        Returns:
+            n/a
+        """
         if self.uses_tabs:
-            self.nvim.command('tabedit AerojumpFilter')
+            calls.append(['nvim_command', ['tabedit AerojumpFilter']])
         else:
-            self.nvim.command('edit AerojumpFilter')
-        self.nvim.command('setlocal buftype=nofile')
-        self.nvim.command('setlocal filetype=AerojumpFilter')
+            calls.append(['nvim_command', ['edit AerojumpFilter']])
+        # Only the handler of the mode in use is called, the async one
+        # is notified so that typing never waits for the host
+        handler = ('AerojumpInsertChangedAsync' if self.use_async
+                   else 'AerojumpInsertChanged')
+        calls += [
+            ['nvim_command', ['setlocal buftype=nofile']],
+            ['nvim_command', ['setlocal filetype=AerojumpFilter']],
+            ['nvim_command', ['autocmd TextChangedI <buffer> call %s('
+                              'getline(1))' % handler]],
+        ]
         if filter_string != '':
             # TODO Idea: Maybe add some special characters
             # like regexp to enforce whole matches only?
-            self.nvim.current.buffer[0] = filter_string
-        self.filt_buf_num = self.nvim.current.buffer.number
-
-    def __set_cursor_position(self, pos):
-        old_win = self.nvim.current.window
-        self.nvim.current.window = self.main_win
-        self.nvim.current.window.cursor = pos
-        self.nvim.current.window = old_win
-
-    def __set_top_pos(self, top_pos):
-        old_win = self.nvim.current.window
-        self.nvim.current.window = self.main_win
-        self.nvim.current.window.cursor = top_pos
-        self.nvim.command('normal! zt')
-        self.nvim.current.window = old_win
+            calls.append(['nvim_set_current_line', [filter_string]])
+        calls += self.keymap_calls
+
+    def __set_cursor_position(self, calls, pos):
+        calls.append(['nvim_win_set_cursor', [self.main_win, pos]])
+
+    def __set_top_pos(self, calls, top_pos):
+        calls += [
+            ['nvim_win_set_cursor', [self.main_win, top_pos]],
+            ['nvim_call_function',
+             ['win_execute', [self.main_win.handle, 'normal! zt']]],
+        ]
+
+    def __send_update(self, calls):
+        """ Applies the calls of an update in one round trip
+
+        Parameters:
+            calls: List of calls of the update
+
+        Returns:
+            n/a
+        """
+        if calls == []:
+            return
+        self.__call_atomic(calls)
+        stats = self.update_stats
+        stats['updates'] += 1
+        stats['calls'] += len(calls)
+        stats['max_calls'] = max(stats['max_calls'], len(calls))
+
+    def __get_snapshot(self, settings, changedtick, file_info):
+        """ Gets the lines of the original buffer, the lines of an
+            earlier session are reused while the buffer is unchanged
+
+        Parameters:
+            settings:       dict of settings
+            changedtick:    b:changedtick of the original buffer
+            file_info:      Buffer info used to read the lines from
+                            its file, see __fetch_lines
+
+        Returns:
+            AerojumpSnapshot of the lines
+        """
+        def get_setting(key):
+            return settings.get(key, DEFAULT_SETTINGS[key])
+        self.snapshots.resize(get_setting('snapshot_entries'),
+                              get_setting('snapshot_memory') * 2**20)
+        max_mirrors = get_setting('attach_buffers')
+
+        number = self.og_buf.number
+        self.aj_changedtick = changedtick
+        mirror = self.mirrors.get(number)
+        if mirror is not None:
+            if mirror[1] == changedtick:
+                self.mirrors.move_to_end(number)
+                self.__limit_mirrors(max_mirrors)
+                self.__apply_changes(mirror)
+                return mirror[2]
+            # Some change was missed
+            self.__detach_buffer(number)
+
+        cached = self.snapshots.get(number)
+        if cached is not None and cached[0] == changedtick:
+            snapshot = cached[1]
+        else:
+            lines = self.__fetch_lines(
+                    get_setting('read_file_min_lines'), file_info)
+            snapshot = AerojumpSnapshot(lines)
+
+        if max_mirrors > 0 and self.og_buf.api.attach(False, {}):
+            # Kept up to date instead of being cached
+            self.snapshots.pop(number)
+            self.mirrors[number] = [self.og_buf, changedtick, snapshot, [], 0]
+        elif cached is None or cached[1] is not snapshot:
+            self.snapshots.put(number, (changedtick, snapshot),
+                               snapshot.get_size())
+        self.__limit_mirrors(max_mirrors)
+        return snapshot
+
+    def __fetch_lines(self, min_lines, file_info):
+        """ Fetches the lines of the original buffer, large unmodified
+            buffers are read from their file instead
+
+        Parameters:
+            min_lines: min number of lines to read from the file, 0
+                       means never
+            file_info: Result of FILE_INFO_EXPR for the buffer
+
+        Returns:
+            List of the lines
+        """
+        if min_lines > 0:
+            (modified, buftype, path, fileencoding, encoding, fileformat,
+             bomb, line_count, first_line, last_line, file_stat, ftime,
+             fsize) = file_info
+            # The file must not have changed since the buffer read or
+            # wrote it, see AerojumpFileStat in plugin/aerojump.vim
+            if (not modified and buftype == '' and path != '' and
+                    line_count >= min_lines and
+                    file_stat == [path, ftime, fsize]):
+                lines = read_buffer_file(
+                        path, fileencoding or encoding, fileformat, bomb)
+                if (lines is not None and len(lines) == line_count and
+                        lines[0] == first_line and lines[-1] == last_line):
+                    return lines
+                self.__log('Could not read the lines from ' + path)
+        return self.og_buf[:]
+
+    def __update_snapshot_size(self, number, snapshot):
+        """ Measures a cached snapshot again, the sessions add
+            masks and indexes to it
+
+        Parameters:
+            number:   buffer number of the snapshot
+            snapshot: the snapshot
+
+        Returns:
+            n/a
+        """
+        cached = self.snapshots.peek(number)
+        if cached is not None and cached[1] is snapshot:
+            self.snapshots.update_size(number, snapshot.get_size())
+
+    def __limit_mirrors(self, max_mirrors):
+        """ Detaches from the least recently searched buffers
+            until at most max_mirrors are attached
+
+        Parameters:
+            max_mirrors: max number of attached buffers
+
+        Returns:
+            n/a
+        """
+        while len(self.mirrors) > max(max_mirrors, 0):
+            self.__detach_buffer(next(iter(self.mirrors)))
+
+    def __apply_changes(self, mirror):
+        """ Applies the queued changes of a mirrored buffer to its lines
+
+        Parameters:
+            mirror: entry of self.mirrors
+
+        Returns:
+            n/a
+        """
+        changes = mirror[3]
+        if changes == []:
+            return
+        mirror[3] = []
+        mirror[4] = 0
+        with self.engine_lock:
+            mirror[2].update(changes)
+
+    def __detach_buffer(self, number):
+        """ Stops mirroring the lines of a buffer
+
+        Parameters:
+            number: buffer number
+
+        Returns:
+            n/a
+        """
+        buffer = self.mirrors.pop(number)[0]
+        try:
+            buffer.api.detach()
+        except neovim.NvimError:
+            # The buffer is gone
+            pass
 
     def __create_aerojumper(
             self, settings, lines, cursor_pos, top_line, num_lines):
-        lin_nums = list(range(1, len(lines) + 1))
+        # The line numbers come with the snapshot
+        lin_nums = None
         if settings['mode'] == 'space':
             return AerojumpSpace(
                     settings, lines, lin_nums, cursor_pos, top_line, num_lines)
@@ -98,93 +466,527 @@ class AerojumpNeovim(object):
             return AerojumpMilk(
                     settings, lines, lin_nums, cursor_pos, top_line, num_lines)
         elif settings['mode'] == 'bolt':
-            settings['bolt_lines_before'] = 1
-            settings['bolt_lines_after'] = 1
             return AerojumpBolt(
                     settings, lines, lin_nums, cursor_pos, top_line, num_lines)
         else:
             return Aerojump(
                     settings, lines, lin_nums, cursor_pos, top_line, num_lines)
 
-    def __update_highlights(self, highlights):
-        self.buf_ref.update_highlights(self.hl_source, highlights, clear=True)
-
-    def __draw(self):
+    def __update_highlights(self, calls, highlights, buffer=None):
+        # The match highlights are only rebuilt when they change
+        if highlights is self.drawn_highlights:
+            return
+        self.drawn_highlights = highlights
+        if buffer is None:
+            buffer = self.buf_ref
+        calls.append(['nvim_exec_lua', [
+            UPDATE_HIGHLIGHTS_LUA, [buffer, self.hl_source, highlights]]])
+
+    def __update_cursor_highlights(self, calls, highlights):
+        calls.append(['nvim_exec_lua', [
+            UPDATE_HIGHLIGHTS_LUA,
+            [self.buf_ref, self.cursor_hl_source, highlights]]])
+
+    def __draw(self, calls):
         if self.filter_string != '':
             # Draw aerojump output
             ret = self.aj.draw()
-            self.buf_ref[:] = ret['lines'][:]
-            self.__update_highlights(ret['highlights'])
-            self.__set_cursor_position(ret['cursor_position'])
+            if self.use_overlay:
+                # The lines of the original buffer are left as they are
+                if self.use_folds:
+                    self.__fold_lines(calls, self.aj.get_hidden_ranges())
+            else:
+                # Only the changed line ranges are sent
+                for start, end, lines in ret['changes']:
+                    calls.append(['nvim_buf_set_lines',
+                                  [self.buf_ref, start, end, True, lines]])
+            self.__update_highlights(calls, ret['highlights'])
+            self.__update_cursor_highlights(calls, ret['cursor_highlights'])
+            self.__set_cursor_position(calls, ret['cursor_position'])
         else:
             # Draw unfiltered output
-            self.buf_ref[:] = self.og_lines[:]
-            self.__set_top_pos(self.top_pos)
-            self.__set_cursor_position(self.og_pos)
+            if not self.use_overlay:
+                calls.append(['nvim_buf_set_lines', [
+                    self.buf_ref, 0, -1, True, self.aj.get_lines()]])
+            self.__set_top_pos(calls, self.top_pos)
+            self.__set_cursor_position(calls, self.og_pos)
 
-    def __create_keymap(self):
-        keymaps = self.default_keymaps.copy()
-        keymaps.update(self.nvim.vars.get("aerojump_keymaps", {}))
-        for k in keymaps:
-            self.nvim.command(f"inoremap <buffer> {k} <ESC>:{keymaps[k]}<CR>")
+    def __draw_navigation(self):
+        """ Draws the cursor after it has moved between the matches
+            and goes back to insert mode in the filter window
 
-    def __resume(self):
-        # Check if we have jumped or not
-        if not self.has_searched:
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        calls = []
+        if self.aj.frame_outdated:
+            # Bolt mode has more results to show
+            self.__draw(calls)
+        else:
+            self.__update_highlights(calls, self.aj.get_highlights())
+            self.__update_cursor_highlights(
+                    calls, self.aj.get_cursor_highlights())
+            self.__set_cursor_position(calls, self.aj.get_cursor())
+        calls += [
+            ['nvim_command', ['startinsert']],
+            ['nvim_command', ['normal! $']],
+        ]
+        self.__send_update(calls)
+
+    def __schedule_pending(self, calls):
+        """ Adds the call that lets Neovim call back to filter the
+            rest of the buffer once the current update has been drawn
+
+        Parameters:
+            calls: List of calls to add to
+
+        Returns:
+            n/a
+        """
+        if self.aj.has_pending():
+            calls.append(['nvim_command', [
+                'call timer_start(0, {-> AerojumpFilterPending(%d)})'
+                % self.filter_generation]])
+
+    def __start_filter_async(self, delay):
+        """ Starts applying the current filter string in the filter
+            thread, giving up any filter that is waiting or running
+
+        Parameters:
+            delay: milliseconds to wait before the filter starts
+
+        Returns:
+            n/a
+        """
+        self.filter_generation += 1
+        if self.filter_timer is not None:
+            self.filter_timer.cancel()
+        self.filter_timer = threading.Timer(
+                delay / 1000, self.__filter_async,
+                [self.filter_generation, self.filter_string])
+        self.filter_timer.start()
+
+    def __filter_async(self, generation, filter_string):
+        """ Applies a filter in the filter thread
+
+        The filter is given up as soon as a newer filter comes
+        along, only the latest filter is drawn
+
+        Parameters:
+            generation:     filter generation of the filter
+            filter_string:  filter string to apply
+
+        Returns:
+            n/a
+        """
+        with self.engine_lock:
+            if generation != self.filter_generation:
+                return
+            has_res = self.aj.apply_filter(filter_string)
+            pending = self.aj.has_pending()
+        if not has_res:
+            self.nvim.async_call(self.__erase_last_char, generation)
             return
+        if pending:
+            # Draw the visible lines while the rest is filtered
+            self.nvim.async_call(self.__schedule_draw, generation)
+        while pending:
+            with self.engine_lock:
+                if generation != self.filter_generation:
+                    return
+                pending = self.aj.filter_pending()
+        self.nvim.async_call(self.__schedule_draw, generation)
+
+    def __schedule_draw(self, generation):
+        """ Lets Neovim call back to draw the result of a filter
+
+        Drawing from a synchronous call keeps it from being
+        interleaved with the other commands
 
-        # Sample positions
-        window = self.nvim.current.window
-        self.current_pos = window.cursor
-        self.og_pos = window.cursor
-        self.nvim.command('normal! H')
-        self.top_pos = window.cursor
+        Parameters:
+            generation: filter generation to draw
+
+        Returns:
+            n/a
+        """
+        if generation == self.filter_generation:
+            self.nvim.command(
+                'call timer_start(0, {-> AerojumpDraw(%d)})' % generation)
+
+    def __erase_last_char(self, generation):
+        """ Erases the last character of a filter without results
+
+        Parameters:
+            generation: filter generation without results
+
+        Returns:
+            n/a
+        """
+        if generation == self.filter_generation:
+            self.filter_string = self.filter_string[:-1]
+            self.__send_update([['nvim_buf_set_lines', [
+                self.filt_buf_num, 0, 1, True, [self.filter_string]]]])
+            # The shorter filter might never have been applied
+            if self.filter_string != '':
+                self.__start_filter_async(0)
+
+    def __watch_scrolling(self, calls, enable):
+        """ Adds the calls that start or stop updating the highlights
+            when the aerojump window scrolls
+
+        Parameters:
+            calls:  List of calls to add to
+            enable: True to start and False to stop
 
-        # Spawn the filter buffer
-        self.__open_aerojump_filter_buf()
-        # Spawn the aerojump buffer
-        self.__open_aerojump_buf()
+        Returns:
+            n/a
+        """
+        calls.append(['nvim_command',
+                      ['augroup AerojumpScroll | autocmd! | augroup END']])
+        if enable:
+            # :autocmd would take the | endif as part of its command
+            calls.append(['nvim_command', [
+                'if exists("##WinScrolled") | '
+                'execute "autocmd AerojumpScroll WinScrolled * '
+                'call AerojumpScrolled()" | endif']])
+
+    def __update_keymap(self, user_keymaps):
+        """ Rebuilds the keymap commands of the filter buffer if
+            the user keymaps have changed
 
-        # Paste the lines of the old buffer to the new
-        new_buf = self.nvim.current.buffer
-        new_buf[:] = self.og_lines[:]
+        Parameters:
+            user_keymaps: g:aerojump_keymaps
 
-        # Restore main win
-        self.main_win = self.nvim.current.window
+        Returns:
+            n/a
+        """
+        if user_keymaps == self.keymaps:
+            return
+        self.keymaps = user_keymaps
+        keymaps = self.default_keymaps.copy()
+        keymaps.update(user_keymaps)
+        self.keymap_calls = [
+            ['nvim_command', [f"inoremap <buffer> {k} <ESC>:{keymaps[k]}<CR>"]]
+            for k in keymaps]
 
-        # Go back to the input buffer window
-        self.nvim.command('wincmd j')
-        self.nvim.current.window.height = 1
-        self.nvim.command("startinsert!")
+    def __open_windows(self, calls, highlights=None):
+        """ Adds the calls that open the filter and aerojump windows
+            and leave the filter window in insert mode
 
-        # Recreate old state
-        self.nvim.current.buffer[0] = self.filter_string
-        self.nvim.command("normal! $")
+        The aerojump window is left with the unfiltered lines at
+        the original position
 
-        self.__create_keymap()
+        Parameters:
+            calls:      List of calls to add to
+            highlights: Match highlights to draw or None
+
+        Returns:
+            Index of the results of the calls that get the filter
+            window, the aerojump buffer and the aerojump window
+        """
+        self.__open_aerojump_filter_buf(calls, self.filter_string)
+        calls.append(['nvim_get_current_win', []])
+        index = len(calls) - 1
+        if self.use_overlay:
+            self.__open_aerojump_overlay(calls)
+        else:
+            self.__open_aerojump_buf(calls)
+            calls.append(['nvim_buf_set_lines',
+                          [0, 0, -1, True, self.aj.get_lines()]])
+        if highlights is not None:
+            self.__update_highlights(calls, highlights, 0)
+        calls += [
+            ['nvim_get_current_buf', []],
+            ['nvim_get_current_win', []],
+        ]
+        aj_index = len(calls) - 2
+        calls += [
+            ['nvim_win_set_cursor', [0, self.top_pos]],
+            ['nvim_command', ['normal! zt']],
+            ['nvim_win_set_cursor', [0, self.og_pos]],
+            # Go back to the input buffer window
+            ['nvim_command', ['wincmd j']],
+            ['nvim_win_set_height', [0, 1]],
+            ['nvim_command', ['startinsert!']],
+        ]
+        self.__watch_scrolling(calls, self.aj.viewport is not None)
+        return (index, aj_index)
+
+    def __opened_windows(self, results, index):
+        """ Keeps the windows and the aerojump buffer that were opened
+
+        Parameters:
+            results: Results of the calls added by __open_windows
+            index:   Index returned by __open_windows
+
+        Returns:
+            n/a
+        """
+        filt_index, aj_index = index
+        # The original window unless tabs are used
+        self.filt_win = results[filt_index]
+        self.buf_ref = results[aj_index]
+        self.main_win = results[aj_index + 1]
+        if not self.use_overlay:
+            self.aerojump_buf_num = self.buf_ref.number
+
+    def __close_session(self):
+        """ Stops the session and gets the calls that close the
+            aerojump windows and restore the original position
+
+        Parameters:
+            n/a
+
+        Returns:
+            List of calls
+        """
+        self.filter_generation += 1
+        if self.filter_timer is not None:
+            self.filter_timer.cancel()
+        with self.engine_lock:
+            self.aj.close()
+        self.__update_snapshot_size(self.og_buf.number, self.aj.snapshot)
+
+        calls = [['nvim_command', ['stopinsert']]]
+        self.__watch_scrolling(calls, False)
+        if self.use_overlay:
+            self.__close_aerojump_overlay(calls)
+        # The original buffer goes back to the window of the filter
+        # buffer, i.e. the original window, and the split is closed
+        calls += [
+            ['nvim_set_current_win', [self.filt_win]],
+            ['nvim_set_current_buf', [self.og_buf]],
+        ]
+        if self.use_overlay:
+            calls.append(['nvim_win_close', [self.main_win, True]])
+        else:
+            calls.append(
+                    ['nvim_command', ['bwipeout %s' % self.aerojump_buf_num]])
+        calls.append(['nvim_command', ['bwipeout %s' % self.filt_buf_num]])
+        if self.uses_tabs:
+            calls.append(['nvim_command', ['tabclose']])
+        # Restore original position
+        calls += [
+            ['nvim_win_set_cursor', [0, self.top_pos]],
+            ['nvim_command', ['normal! zt']],
+            ['nvim_win_set_cursor', [0, self.og_pos]],
+        ]
+        return calls
+
+    def __resume(self):
+        # Check if we have jumped or not
+        if not self.has_searched:
+            return False
+
+        # Sample positions
+        current_pos, _, top_pos = self.__call_atomic([
+            ['nvim_win_get_cursor', [0]],
+            ['nvim_command', ['normal! H']],
+            ['nvim_win_get_cursor', [0]],
+        ])
+        self.current_pos = tuple(current_pos)
+        self.og_pos = tuple(current_pos)
+        self.top_pos = tuple(top_pos)
+
+        # The mirrored lines have changed since the last session
+        mirror = self.mirrors.get(self.og_buf.number)
+        if (mirror is not None and mirror[2] is self.aj.snapshot and
+                mirror[1] != self.aj_changedtick):
+            self.__apply_changes(mirror)
+            self.aj = self.__create_aerojumper(
+                    self.aj.settings, mirror[2], self.og_pos,
+                    self.top_pos, self.window_height)
+            self.aj_changedtick = mirror[1]
+            if not self.aj.apply_filter(self.filter_string):
+                self.has_searched = False
+                return False
+
+        self.drawn_highlights = None
+        # Cursor moves only update the cursor highlights
+        with self.engine_lock:
+            self.aj.reset_frame()
+            highlights = self.aj.get_highlights()
+
+        # Spawn the filter and aerojump buffers with the old state
+        calls = []
+        index = self.__open_windows(calls, highlights)
+        calls.append(['nvim_get_current_buf', []])
+        filt_index = len(calls) - 1
+        calls.append(['nvim_command', ['normal! $']])
+        self.__schedule_pending(calls)
+        results = self.__call_atomic(calls)
+        self.__opened_windows(results, index)
+        self.filt_buf_num = results[filt_index].number
+        return True
 
     # Aerojump Commands
     # ====================
-    @neovim.autocmd("TextChangedI", pattern='AerojumpFilter', sync=True)
-    def insert_changed(self):
-        """ Autocmd for when text changes
+    @neovim.function("AerojumpInsertChanged", sync=True)
+    def insert_changed(self, args):
+        """ Called by the TextChangedI autocmd of the filter buffer
 
         Parameters:
-            n/a
+            args[0]: The content of the filter buffer
 
         Returns:
             n/a
         """
-        if self.filter_string == self.nvim.current.line:
+        filter_string = args[0]
+        if self.use_async:
+            return
+        if self.filter_string == filter_string:
             return
-        self.filter_string = self.nvim.current.line
+        self.filter_string = filter_string
+        self.filter_generation += 1
         has_res = self.aj.apply_filter(self.filter_string)
+        calls = []
         if has_res:
-            self.__draw()
+            self.__draw(calls)
+            self.__schedule_pending(calls)
         else:
             # Erase the last character
             self.filter_string = self.filter_string[:-1]
-            self.nvim.current.line = self.filter_string
+            calls.append(['nvim_set_current_line', [self.filter_string]])
+        self.__send_update(calls)
+
+    @neovim.function("AerojumpInsertChangedAsync", sync=False)
+    def insert_changed_async(self, args):
+        """ Called by the TextChangedI autocmd of the filter buffer
+            in async mode, i.e. without waiting for the host
+
+        The filter is applied in the filter thread after a short
+        delay, any filter still waiting or running is given up
+
+        Parameters:
+            args[0]: The content of the filter buffer
+
+        Returns:
+            n/a
+        """
+        filter_string = args[0]
+        if not self.use_async or self.filter_string == filter_string:
+            return
+        self.filter_string = filter_string
+        self.__start_filter_async(self.aj.settings['async_delay'])
+
+    @neovim.function("AerojumpDraw", sync=True)
+    def AerojumpDraw(self, args):
+        """ Draws the result of an async filter
+
+        Parameters:
+            args[0]: Filter generation the call was scheduled for
+
+        Returns:
+            n/a
+        """
+        if args[0] != self.filter_generation:
+            # A newer filter has been applied since
+            return
+        with self.engine_lock:
+            calls = []
+            self.__draw(calls)
+            self.__send_update(calls)
+
+    @neovim.function("AerojumpScrolled", sync=True)
+    def AerojumpScrolled(self, args):
+        """ Highlights the matches around the lines in view
+            after the aerojump window has scrolled
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        win = self.main_win.handle
+        first_line, last_line = self.nvim.eval(
+                "[line('w0', %d), line('w$', %d)]" % (win, win))
+        with self.engine_lock:
+            if self.aj.set_viewport(first_line, last_line):
+                calls = []
+                self.__update_highlights(calls, self.aj.get_highlights())
+                self.__update_cursor_highlights(
+                        calls, self.aj.get_cursor_highlights())
+                self.__send_update(calls)
+
+    @neovim.function("AerojumpFilterPending", sync=True)
+    def AerojumpFilterPending(self, args):
+        """ Filters the next chunk of the lines that were
+            left when the visible lines were filtered first
+
+        Parameters:
+            args[0]: Filter generation the call was scheduled for
+
+        Returns:
+            n/a
+        """
+        if args[0] != self.filter_generation:
+            # A newer filter has been applied since
+            return
+        self.aj.filter_pending()
+        calls = []
+        self.__draw(calls)
+        self.__schedule_pending(calls)
+        self.__send_update(calls)
+
+    @neovim.rpc_export('nvim_buf_lines_event', sync=False)
+    def on_buf_lines(self, buffer, changedtick, firstline, lastline,
+                     linedata, more):
+        """ Queues a change of an attached buffer, the changes are
+            applied together when the lines are needed
+
+        Parameters:
+            buffer:      the buffer that changed
+            changedtick: b:changedtick after the change or None
+            firstline:   index of the first replaced line
+            lastline:    index of the first line after the replaced ones
+            linedata:    the new lines
+            more:        n/a
+
+        Returns:
+            n/a
+        """
+        mirror = self.mirrors.get(buffer.number)
+        if mirror is None:
+            return
+        mirror[3].append((firstline, lastline, linedata))
+        mirror[4] += 1 + len(linedata)
+        if mirror[4] > len(mirror[2].lines):
+            # Fetching the lines again is cheaper than the changes
+            self.__detach_buffer(buffer.number)
+            return
+        if changedtick is not None:
+            mirror[1] = changedtick
+
+    @neovim.rpc_export('nvim_buf_changedtick_event', sync=False)
+    def on_buf_changedtick(self, buffer, changedtick):
+        """ Follows the changedtick of an attached buffer
+
+        Parameters:
+            buffer:      the buffer
+            changedtick: the new b:changedtick
+
+        Returns:
+            n/a
+        """
+        mirror = self.mirrors.get(buffer.number)
+        if mirror is not None:
+            mirror[1] = changedtick
+
+    @neovim.rpc_export('nvim_buf_detach_event', sync=False)
+    def on_buf_detach(self, buffer):
+        """ Forgets a buffer that Neovim has detached from
+
+        Parameters:
+            buffer: the buffer
+
+        Returns:
+            n/a
+        """
+        self.mirrors.pop(buffer.number, None)
 
     @neovim.command("AerojumpResumeNext", range='', nargs='*', sync=True)
     def AerojumpResumeNext(self, args, range):
@@ -196,8 +998,8 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.__resume()
-        self.AerojumpSelNext('', '')
+        if self.__resume():
+            self.AerojumpSelNext('', '')
 
     @neovim.command("AerojumpResumePrev", range='', nargs='*', sync=True)
     def AerojumpResumePrev(self, args, range):
@@ -209,8 +1011,8 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.__resume()
-        self.AerojumpSelPrev('', '')
+        if self.__resume():
+            self.AerojumpSelPrev('', '')
 
     @neovim.command("Aerojump", range='', nargs='*', sync=True)
     def Aerojump(self, args, range):
@@ -225,64 +1027,87 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.uses_tabs = self.nvim.vars.get("aerojump_uses_tabs")
+        # Buffer of the previous session
+        last_number = self.og_buf.number if self.aj is not None else None
+
+        # Everything needed from Neovim is sampled in one go
+        results = self.__call_atomic([
+            ['nvim_eval', ['filter(copy(g:), \'v:key =~# "^aerojump_"\')']],
+            ['nvim_call_function', ['expand', ['<cword>']]],
+            ['nvim_get_current_buf', []],
+            ['nvim_win_get_height', [0]],
+            ['nvim_win_get_cursor', [0]],
+            ['nvim_command', ['normal! H']],
+            ['nvim_win_get_cursor', [0]],
+            ['nvim_eval', ['&filetype']],
+            ['nvim_buf_get_changedtick', [0]],
+            ['nvim_eval', [FILE_INFO_EXPR]],
+        ])
+        (variables, cword, self.og_buf, window_height, current_pos, _,
+         top_pos, self.ft, changedtick, file_info) = results
+
+        self.uses_tabs = variables.get("aerojump_uses_tabs")
         filter_string = ''
         settings = {}
         settings['input'] = args[0]
         settings['mode'] = args[1]
+        for key in DEFAULT_SETTINGS:
+            value = variables.get('aerojump_' + key)
+            if value is not None:
+                settings[key] = value
+        self.__update_keymap(variables.get("aerojump_keymaps", {}))
+
+        # Bolt mode rearranges the lines so it always draws in a buffer
+        self.use_overlay = (
+                bool(settings.get('overlay', DEFAULT_SETTINGS['overlay'])) and
+                settings['mode'] != 'bolt')
+        self.use_folds = self.use_overlay and settings['mode'] == 'space'
 
         if settings['input'] == 'cursor':
-            filter_string = self.nvim.eval('expand(\'<cword>\')').strip('\n')
+            filter_string = cword.strip('\n')
 
         self.has_searched = True
         self.has_filter = False
-        self.hl_source = self.nvim.new_highlight_source()
-        self.og_buf = self.nvim.current.buffer
-        self.og_lines = self.nvim.current.buffer[:]
-        window = self.nvim.current.window
+        if self.hl_source is None:
+            self.hl_source = self.nvim.new_highlight_source()
+            # Created last to be painted on top of the match highlights
+            self.cursor_hl_source = self.nvim.new_highlight_source()
+        self.drawn_highlights = None
+        snapshot = self.__get_snapshot(settings, changedtick, file_info)
 
         # Height could be used to optimize performance?
-        self.window_height = window.height
+        self.window_height = window_height
 
         # Sample positions
-        self.current_pos = window.cursor
-        self.og_pos = window.cursor
-        self.nvim.command('normal! H')
-        self.top_pos = window.cursor
-
-        # Sample current filetype
-        resp = self.nvim.command_output('set filetype?')
-        self.ft = resp.split('=')[1]
-
-        # Spawn the filter buffer
-        self.__open_aerojump_filter_buf(filter_string)
-
-        # Spawn the aerojump buffer
-        self.__open_aerojump_buf()
+        self.current_pos = tuple(current_pos)
+        self.og_pos = tuple(current_pos)
+        self.top_pos = tuple(top_pos)
 
-        # Reference to the aerojump buffer
-        self.buf_ref = self.nvim.current.buffer
+        # Only the last session can be resumed, the matches and index
+        # it left in another snapshot would stay beyond the snapshot
+        # memory limit
+        if self.aj is not None and self.aj.snapshot is not snapshot:
+            self.aj.snapshot.release()
+            self.__update_snapshot_size(last_number, self.aj.snapshot)
 
         # Create lines
         self.aj = self.__create_aerojumper(
-                settings, self.og_lines, self.og_pos,
+                settings, snapshot, self.og_pos,
                 self.top_pos, self.window_height
                 )
 
-        # Update position
-        self.main_win = self.nvim.current.window
-
-        # Go back to the input buffer window
-        self.nvim.command('wincmd j')
-        self.nvim.current.window.height = 1
-        self.nvim.command("startinsert!")
-
-        # Reset the filter string
+        self.use_async = bool(self.aj.settings['async'])
+
+        # Spawn the filter and aerojump buffers, the filter string
+        # is reset since only typing applies it
+        self.filter_string = filter_string
+        calls = []
+        index = self.__open_windows(calls)
+        calls.append(['nvim_get_current_buf', []])
+        results = self.__call_atomic(calls)
+        self.__opened_windows(results, index)
+        self.filt_buf_num = results[-1].number
         self.filter_string = ''
-        self.__draw()
-
-        # Create keymap
-        self.__create_keymap()
 
     @neovim.command("AerojumpShowLog", range='', nargs='*', sync=True)
     def AerojumpShowLog(self, args, range):
@@ -300,6 +1125,10 @@ class AerojumpNeovim(object):
         self.nvim.current.buffer.append(self.logstr)
         self.nvim.current.buffer.append('== Aerojump log ==')
         self.nvim.current.buffer.extend(self.aj.get_log())
+        stats = self.update_stats
+        self.nvim.current.buffer.append(
+            'Updates: %d, calls: %d, max calls per update: %d'
+            % (stats['updates'], stats['calls'], stats['max_calls']))
 
     @neovim.command("AerojumpUp", range='', nargs='*', sync=True)
     def AerojumpUp(self, args, range):
@@ -311,13 +1140,9 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.aj.cursor_line_up()
-        # TODO: [Performance] Incremental update of highlights?
-        self.__update_highlights(self.aj.get_highlights())
-        self.main_win.cursor = self.aj.get_cursor()
-
-        self.nvim.command('startinsert')
-        self.nvim.command('normal! $')
+        with self.engine_lock:
+            self.aj.cursor_line_up()
+            self.__draw_navigation()
 
     @neovim.command("AerojumpDown", range='', nargs='*', sync=True)
     def AerojumpDown(self, args, range):
@@ -329,13 +1154,9 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.aj.cursor_line_down()
-        # TODO: [Performance] Incremental update of highlights?
-        self.__update_highlights(self.aj.get_highlights())
-        self.main_win.cursor = self.aj.get_cursor()
-
-        self.nvim.command('startinsert')
-        self.nvim.command('normal! $')
+        with self.engine_lock:
+            self.aj.cursor_line_down()
+            self.__draw_navigation()
 
     @neovim.command("AerojumpSelNext", range='', nargs='*', sync=True)
     def AerojumpSelNext(self, args, range):
@@ -347,13 +1168,9 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.aj.cursor_match_next()
-        # TODO: [Performance] Incremental update of highlights?
-        self.__update_highlights(self.aj.get_highlights())
-        self.main_win.cursor = self.aj.get_cursor()
-
-        self.nvim.command('startinsert')
-        self.nvim.command('normal! $')
+        with self.engine_lock:
+            self.aj.cursor_match_next()
+            self.__draw_navigation()
 
     @neovim.command("AerojumpSelPrev", range='', nargs='*', sync=True)
     def AerojumpSelPrev(self, args, range):
@@ -365,13 +1182,9 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.aj.cursor_match_prev()
-        # TODO: [Performance] Incremental update of highlights?
-        self.__update_highlights(self.aj.get_highlights())
-        self.main_win.cursor = self.aj.get_cursor()
-
-        self.nvim.command('startinsert')
-        self.nvim.command('normal! $')
+        with self.engine_lock:
+            self.aj.cursor_match_prev()
+            self.__draw_navigation()
 
     @neovim.command("AerojumpSelect", range='', nargs='*', sync=True)
     def AerojumpSelect(self, args, range):
@@ -383,21 +1196,25 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        cursor = self.aj.get_final_cursor()
+        with self.engine_lock:
+            cursor = self.aj.get_final_cursor()
 
         # Sample position in aj window
-        window = self.main_win
-        self.nvim.current.window = window
-        self.nvim.command('normal! H')
-        top_pos = window.cursor
-
-        self.AerojumpExit('', '')
-
-        self.nvim.current.window.cursor = top_pos
-        self.nvim.command('normal! zt')
-        # Doing it this way respects jump stack
-        self.nvim.command('normal! ' + str(cursor[0]) + 'G')
-        self.nvim.command('normal! ' + str(cursor[1]+1) + '|')
+        top_pos = self.__call_atomic([
+            ['nvim_set_current_win', [self.main_win]],
+            ['nvim_command', ['normal! H']],
+            ['nvim_win_get_cursor', [0]],
+        ])[-1]
+
+        calls = self.__close_session()
+        calls += [
+            ['nvim_win_set_cursor', [0, top_pos]],
+            ['nvim_command', ['normal! zt']],
+            # Doing it this way respects jump stack
+            ['nvim_command', ['normal! ' + str(cursor[0]) + 'G']],
+            ['nvim_command', ['normal! ' + str(cursor[1]+1) + '|']],
+        ]
+        self.__call_atomic(calls)
 
     @neovim.command("AerojumpExit", range='', nargs='*', sync=True)
     def AerojumpExit(self, args, range):
@@ -409,13 +1226,4 @@ class AerojumpNeovim(object):
         Returns:
             n/a
         """
-        self.nvim.command('stopinsert')
-        self.nvim.current.buffer = self.og_buf
-        self.nvim.command('bwipeout %s' % self.aerojump_buf_num)
-        self.nvim.command('bwipeout %s' % self.filt_buf_num)
-        if self.uses_tabs:
-            self.nvim.command('tabclose')
-        # Restore original position
-        self.nvim.current.window.cursor = self.top_pos
-        self.nvim.command('normal! zt')
-        self.nvim.current.window.cursor = self.og_pos
+        self.__call_atomic(self.__close_session())
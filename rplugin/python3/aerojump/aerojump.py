@@ -10,29 +10,787 @@
 #  (reward closeness in a better way) (done?!)
 # ============================================================================
 
+import heapq
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import accumulate, chain, islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Changed line ranges above this count are drawn as a single range
+MAX_DRAW_RANGES = 64
+
+# Number of lines that are split out of the packed text at a time
+TEXT_CHUNK_LINES = 4096
+
+# Default values for the settings that can be
+# overridden through g:aerojump_<setting>
+DEFAULT_SETTINGS = {
+    # Engine used to find the candidate lines of a filter,
+    # 'python' or 'numpy' (falls back to 'python' without numpy)
+    'engine':           'python',
+    # Number of worker processes used to filter large buffers, 0 disables
+    'parallel_workers': 0,
+    # Min number of lines to filter before the workers are used
+    'parallel_min_lines': 50000,
+    # Filters of more lines than this are done for the visible lines
+    # first and the rest in chunks of this size, 0 disables
+    'progressive_lines': 20000,
+    # Filter in a background thread instead of blocking Neovim
+    'async':            0,
+    # Milliseconds to wait for more input before an async filter starts
+    'async_delay':      30,
+    # Only highlight the matches around the lines in view
+    'viewport_highlights': 0,
+    # Number of lines above and below the view that are highlighted too
+    'viewport_margin':  50,
+    # Draw on the window of the original buffer instead of a copy of it
+    'overlay':          0,
+    # Number of lines above and below each result that bolt mode shows
+    'bolt_lines_before': 1,
+    'bolt_lines_after':  1,
+    # Number of results that bolt mode draws at a time, the next ones
+    # are drawn when the cursor moves past the last one, 0 draws all
+    'bolt_page_size':   100,
+    # Number of buffers whose lines are kept for later sessions
+    'snapshot_entries': 4,
+    # Max megabytes of buffer lines kept for later sessions
+    'snapshot_memory':  256,
+    # Unmodified buffers with at least this many lines are
+    # read from their file instead of over RPC, 0 disables
+    'read_file_min_lines': 10000,
+    # Max number of buffers whose lines are kept up to date
+    # from their change events, 0 disables
+    'attach_buffers':   0,
+    # Number of filter results that are kept for backspacing
+    'cache_entries':    32,
+    # Max number of line hits and match positions kept by the cache
+    'cache_size':       1000000,
+    # Max number of matches that are found in a line at a time, more
+    # are found when the cursor moves past the last one, 0 disables
+    'line_matches':     1000,
+    # Max number of matches that a filter finds in all lines, the lines
+    # past it get one match until the cursor reaches them, 0 disables
+    'filter_matches':   1000000,
+}
+
 # Aerojump classes
 # ====================
 
+# Matches of a line without hits, shared and never modified
+_NO_MATCHES = []
+
+# Lines of the buffer in a worker process of the parallel engine
+_worker_text = None
+_worker_lines = {}
+
+
+def _worker_init(text):
+    """ Initializer of the worker processes
+
+    Parameters:
+        text: AerojumpText of all lines in the buffer
+
+    Returns:
+        n/a
+    """
+    global _worker_text
+    global _worker_lines
+    _worker_text = text
+    _worker_lines = {}
+    # The stdin and stdout of the host carry its RPC channel
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+
+def _get_start_method():
+    """ Picks how the worker processes are started
+
+    Forking is only safe on Linux while the host has no other threads,
+    e.g. the filter thread of the async mode, elsewhere the workers are
+    started by a fork server or as new interpreters
+
+    Parameters:
+        n/a
+
+    Returns:
+        Name of the start method
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if (sys.platform.startswith('linux') and 'fork' in methods and
+            threading.active_count() == 1):
+        return 'fork'
+    if 'forkserver' in methods:
+        return 'forkserver'
+    return 'spawn'
+
+
+def _worker_filter(pattern, indices, line_matches):
+    """ Filters a shard of the buffer in a worker process
+
+    The limit of the matches of the whole filter is applied when the
+    shards are merged since it depends on the lines before the shard
+
+    Parameters:
+        pattern:      Filter pattern
+        indices:      Indices of the lines in the shard
+        line_matches: Max number of matches to find in a line
+
+    Returns:
+        List of (index, matches, scores, runs, best_index, truncated)
+        for the matching lines
+    """
+    hits = []
+    for i in indices:
+        line = _worker_lines.get(i)
+        if line is None:
+            line = AerojumpLine(_worker_text, i + 1)
+            _worker_lines[i] = line
+        if line.is_subsequence(pattern):
+            line.filter(pattern, line_matches)
+            if line.matches != []:
+                hits.append((i, line.matches, line.scores, line.runs,
+                             line.best_index, line.truncated))
+        else:
+            line.clear(pattern)
+    return hits
+
+
+def _get_match_limit(line_matches, matches_left):
+    """ Gets the max number of matches to find in the next line
+
+    Parameters:
+        line_matches: Max number of matches in a line, 0 for no limit
+        matches_left: Number of matches left for the rest of the lines
+                      of a filter, None for no limit
+
+    Returns:
+        Max number of matches, 0 for no limit
+    """
+    if matches_left is None:
+        return line_matches
+    # Lines still need a match to be hits
+    limit = max(matches_left, 1)
+    if line_matches > 0:
+        limit = min(limit, line_matches)
+    return limit
+
+
+def _bisect_lines(lines, num):
+    """ Binary search among lines sorted by line number
+
+    Parameters:
+        lines: list of AerojumpLine sorted by num
+        num:   line number to search for
+
+    Returns:
+        Index of the first line with a line number >= num
+    """
+    lo = 0
+    hi = len(lines)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if lines[mid].num < num:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _get_runs(match):
+    """ Splits a match into runs of adjacent characters
+
+    Parameters:
+        match: 1-indexed positions of the matched characters
+
+    Returns:
+        List of (col_start, col_end) for each run, 0-indexed and
+        with an exclusive end like the highlights
+    """
+    runs = []
+    start = match[0]
+    for i in range(1, len(match)):
+        if match[i] - match[i-1] != 1:
+            runs.append((start - 1, match[i-1]))
+            start = match[i]
+    runs.append((start - 1, match[-1]))
+    return runs
+
+
+def _merge_runs(runs):
+    """ Merges overlapping and adjacent runs
+
+    Parameters:
+        runs: List of (col_start, col_end)
+
+    Returns:
+        Sorted list of disjoint (col_start, col_end)
+    """
+    merged = []
+    for start, end in sorted(runs):
+        if merged != [] and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _get_num_ranges(nums):
+    """ Groups line numbers into ranges of consecutive numbers
+
+    Parameters:
+        nums: Sorted list of line numbers
+
+    Returns:
+        List of (first_num, last_num)
+    """
+    ranges = []
+    for num in nums:
+        if ranges != [] and num == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], num)
+        else:
+            ranges.append((num, num))
+    return ranges
+
+
+def _get_gaps(lines, first_num, last_num):
+    """ Finds the line numbers between first_num and last_num
+        that none of the lines have
+
+    Parameters:
+        lines:      Lines sorted by line number
+        first_num:  First line number of the range
+        last_num:   Last line number of the range
+
+    Returns:
+        List of (first_num, last_num) of the gaps
+    """
+    gaps = []
+    prev_num = first_num - 1
+    for l in lines:
+        if l.num > prev_num + 1:
+            gaps.append((prev_num + 1, l.num - 1))
+        prev_num = l.num
+    if prev_num < last_num:
+        gaps.append((prev_num + 1, last_num))
+    return gaps
+
+
+def _diff_lines(old_lines, new_lines):
+    """ Finds the range of lines that differs between two frames
+
+    Parameters:
+        old_lines: List of lines that are drawn
+        new_lines: List of lines that shall be drawn
+
+    Returns:
+        List of (start, end, lines) replacing old_lines[start:end]
+    """
+    old_len = len(old_lines)
+    new_len = len(new_lines)
+    start = 0
+    while (start < old_len and start < new_len and
+           old_lines[start] == new_lines[start]):
+        start += 1
+    if start == old_len and start == new_len:
+        return []
+    end = 0
+    while (end < old_len - start and end < new_len - start and
+           old_lines[old_len - 1 - end] == new_lines[new_len - 1 - end]):
+        end += 1
+    return [(start, old_len - end, new_lines[start:new_len - end])]
+
+
+class AerojumpCache(object):
+    """ Bounded cache that evicts the least recently used entries """
+    def __init__(self, max_entries, max_size):
+        """ Constructor for the aerojump cache class
+
+        Parameters:
+            max_entries: max number of entries in the cache
+            max_size:    max total size of the entries in the cache
+
+        Returns:
+            Aerojump cache object
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """ Fetches an entry and marks it as recently used
+
+        Parameters:
+            key: key of the entry
+
+        Returns:
+            The cached value or None
+        """
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, size):
+        """ Adds an entry, evicting old entries to stay within bounds
+
+        Parameters:
+            key:   key of the entry
+            value: value to cache
+            size:  size of the value
+
+        Returns:
+            n/a
+        """
+        self.pop(key)
+        if size > self.max_size or self.max_entries <= 0:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        self._evict()
+
+    def peek(self, key):
+        """ Fetches an entry without marking it as recently used
+
+        Parameters:
+            key: key of the entry
+
+        Returns:
+            The cached value or None
+        """
+        entry = self.entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def update_size(self, key, size):
+        """ Changes the size of an entry, evicting old entries
+            if it no longer fits
+
+        The entry is not marked as recently used
+
+        Parameters:
+            key:  key of the entry
+            size: new size of the value
+
+        Returns:
+            n/a
+        """
+        if key not in self.entries:
+            return
+        value, old_size = self.entries[key]
+        self.entries[key] = (value, size)
+        self.size += size - old_size
+        self._evict()
+
+    def resize(self, max_entries, max_size):
+        """ Changes the bounds of the cache, evicting old entries
+            that no longer fit
+
+        Parameters:
+            max_entries: max number of entries in the cache
+            max_size:    max total size of the entries in the cache
+
+        Returns:
+            n/a
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._evict()
+
+    def _evict(self):
+        """ Evicts the least recently used entries until the
+            cache is within its bounds
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        while (len(self.entries) > self.max_entries or
+                self.size > self.max_size):
+            self.size -= self.entries.popitem(last=False)[1][1]
+
+    def pop(self, key):
+        """ Removes an entry from the cache
+
+        Parameters:
+            key: key of the entry
+
+        Returns:
+            n/a
+        """
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+
+class AerojumpNumpyIndex(object):
+    """ Vectorized index over the lowercase text of all lines """
+    def __init__(self, text):
+        """ Constructor for the aerojump numpy index class
+
+        Converts the lowercase text into one contiguous array of code
+        points with a table of where each line starts and ends
+
+        Parameters:
+            text: AerojumpText of all lines
+
+        Returns:
+            Aerojump numpy index object
+        """
+        self.text = numpy.frombuffer(
+                text.lower.encode('utf-32-le', 'surrogatepass'),
+                dtype=numpy.uint32)
+        offsets = numpy.frombuffer(text.lower_offsets, dtype=numpy.int64)
+        self.starts = offsets[:-1]
+        self.ends = offsets[1:] - 1
+        # Positions of each character in text, built on demand
+        self.char_positions = {}
+
+    def get_size(self):
+        """ Estimates the memory used by the index
+
+        Parameters:
+            n/a
+
+        Returns:
+            Size in bytes
+        """
+        # The line starts and ends are views of the text offsets
+        return self.text.nbytes + sum(
+                positions.nbytes for positions in self.char_positions.values())
+
+    def _get_char_positions(self, c):
+        """ Returns the positions of a character in the packed text
+
+        Parameters:
+            c: Character to look up
+
+        Returns:
+            Sorted array of positions
+        """
+        positions = self.char_positions.get(c)
+        if positions is None:
+            positions = numpy.flatnonzero(self.text == ord(c))
+            self.char_positions[c] = positions
+        return positions
+
+    def get_candidates(self, pattern):
+        """ Finds the lines where the characters of the
+            pattern appear in order
+
+        Every line is processed at once, for each character of the
+        pattern the next position of it is looked up for all lines
+        that are still alive
+
+        Parameters:
+            pattern: Filter pattern
+
+        Returns:
+            Array of the indices of the candidate lines
+        """
+        indices = numpy.arange(len(self.starts))
+        pos = self.starts
+        for c in pattern:
+            positions = self._get_char_positions(c)
+            if len(positions) == 0:
+                return positions
+            i = numpy.searchsorted(positions, pos)
+            alive = i < len(positions)
+            indices = indices[alive]
+            pos = positions[i[alive]]
+            alive = pos < self.ends[indices]
+            indices = indices[alive]
+            pos = pos[alive] + 1
+        return indices
+
+
+def _merge_changes(changes, num_lines):
+    """ Merges changes into ranges of the lines before them
+
+    Parameters:
+        changes:   List of (first, last, lines) in the order they were
+                   made, each replaces the lines [first, last) as they
+                   were after the previous change, last is -1 for the
+                   end of the lines
+        num_lines: number of lines before the changes
+
+    Returns:
+        List of (first, last, lines) sorted by line, each replaces the
+        lines [first, last) as they were before the changes
+    """
+    # [first, last, lines] of the original lines, the lines between
+    # the ranges are moved by the ranges before them
+    ranges = []
+    for first, last, lines in changes:
+        shift = 0
+        i = 0
+        # Ranges that end before the change are left alone
+        while (i < len(ranges) and
+               ranges[i][0] + shift + len(ranges[i][2]) < first):
+            shift += len(ranges[i][2]) - (ranges[i][1] - ranges[i][0])
+            i += 1
+        if last < 0:
+            last = num_lines + shift + sum(
+                    len(r[2]) - (r[1] - r[0]) for r in ranges[i:])
+        # The change and the ranges it touches become one range
+        if i < len(ranges) and ranges[i][0] + shift <= first:
+            merged_first = ranges[i][0]
+            before = ranges[i][2][:first - (ranges[i][0] + shift)]
+        else:
+            merged_first = first - shift
+            before = []
+        merged_last = last - shift
+        after = []
+        j = i
+        while j < len(ranges) and ranges[j][0] + shift <= last:
+            start = ranges[j][0] + shift
+            merged_last = ranges[j][1]
+            after = ranges[j][2][last - start:]
+            shift += len(ranges[j][2]) - (ranges[j][1] - ranges[j][0])
+            if start + len(ranges[j][2]) < last:
+                # The change goes past the range
+                merged_last = last - shift
+                after = []
+            j += 1
+        ranges[i:j] = [[merged_first, merged_last,
+                        before + list(lines) + after]]
+    return [tuple(r) for r in ranges]
+
+
+def _splice_lines(text, offsets, changes):
+    """ Replaces lines of a packed text
+
+    Every line of the text ends with a newline, line i
+    is text[offsets[i]:offsets[i + 1] - 1]
+
+    Parameters:
+        text:    the packed text
+        offsets: array of where each line starts, followed by the
+                 length of the text
+        changes: List of (first, last, lines) sorted by line, each
+                 replaces the lines [first, last) with lines
+
+    Returns:
+        The new text and offsets
+    """
+    pieces = []
+    new_offsets = array('q')
+    prev = 0
+    shift = 0
+    for first, last, lines in changes:
+        # The lines between the changes move as a whole
+        pieces.append(text[offsets[prev]:offsets[first]])
+        if shift == 0:
+            new_offsets.extend(offsets[prev:first])
+        else:
+            new_offsets.extend(o + shift for o in offsets[prev:first])
+        start = offsets[first] + shift
+        replacement = '\n'.join(chain(lines, ('',)))
+        pieces.append(replacement)
+        new_offsets.extend(islice(accumulate(
+                chain((start,), (len(l) + 1 for l in lines))), len(lines)))
+        shift += len(replacement) - (offsets[last] - offsets[first])
+        prev = last
+    pieces.append(text[offsets[prev]:])
+    if shift == 0:
+        new_offsets.extend(offsets[prev:])
+    else:
+        new_offsets.extend(o + shift for o in offsets[prev:])
+    return ''.join(pieces), new_offsets
+
+
+class AerojumpText(object):
+    """ The text of all lines of a buffer packed into one string """
+    def __init__(self, lines):
+        """ Constructor for the aerojump text class
+
+        Parameters:
+            lines: the text of the lines
+
+        Returns:
+            Aerojump text object
+        """
+        # Line i is text[offsets[i]:offsets[i + 1] - 1]
+        self.text, self.offsets = _splice_lines(
+                '', array('q', [0]), [(0, 0, lines)])
+
+        # Lowercase text, the same string when nothing needs folding
+        lower = self.text.lower()
+        if lower == self.text:
+            self.lower = self.text
+            self.lower_offsets = self.offsets
+        elif len(lower) == len(self.text):
+            self.lower = lower
+            self.lower_offsets = self.offsets
+        else:
+            # Some characters grow when lowered
+            self.lower, self.lower_offsets = _splice_lines(
+                    '', array('q', [0]), [(0, 0, [l.lower() for l in lines])])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def replace_lines(self, changes):
+        """ Replaces ranges of lines
+
+        Parameters:
+            changes: List of (first, last, lines) sorted by line, each
+                     replaces the lines [first, last) with lines
+
+        Returns:
+            n/a
+        """
+        old_lower = self.lower
+        old_lower_offsets = self.lower_offsets
+        shares_lower = self.lower is self.text
+        shares_offsets = self.lower_offsets is self.offsets
+        lower_changes = [(first, last, [l.lower() for l in lines])
+                         for first, last, lines in changes]
+
+        self.text, self.offsets = _splice_lines(
+                self.text, self.offsets, changes)
+        if shares_lower and lower_changes == changes:
+            self.lower = self.text
+            self.lower_offsets = self.offsets
+            return
+
+        # The unchanged lines of a shared lower text are lowercase already
+        self.lower, lower_offsets = _splice_lines(
+                old_lower, old_lower_offsets, lower_changes)
+        if shares_offsets and all(
+                len(l) == len(lower)
+                for change, lower_change in zip(changes, lower_changes)
+                for l, lower in zip(change[2], lower_change[2])):
+            self.lower_offsets = self.offsets
+        else:
+            self.lower_offsets = lower_offsets
+
+    def get_line(self, index):
+        """ Gets the text of a line
+
+        Parameters:
+            index: index of the line
+
+        Returns:
+            String of the line
+        """
+        return self.text[self.offsets[index]:self.offsets[index + 1] - 1]
+
+    def get_lower_line(self, index):
+        """ Gets the lowercase text of a line
+
+        Parameters:
+            index: index of the line
+
+        Returns:
+            String of the line
+        """
+        return self.lower[
+                self.lower_offsets[index]:self.lower_offsets[index + 1] - 1]
+
+    def get_lines(self):
+        """ Gets the text of all lines
+
+        Parameters:
+            n/a
+
+        Returns:
+            List of strings
+        """
+        lines = self.text.split('\n')
+        # The last line ends with a newline too
+        lines.pop()
+        if len(lines) != len(self):
+            # Some lines contain newlines (NUL in Neovim)
+            lines = [self.get_line(i) for i in range(0, len(self))]
+        return lines
+
+    def iter_lower_lines(self):
+        """ Iterates over the lowercase text of all lines
+
+        The text is split a chunk of lines at a time so that
+        no more than a chunk of line strings exist at once
+
+        Parameters:
+            n/a
+
+        Yields:
+            String of each line
+        """
+        offsets = self.lower_offsets
+        for first in range(0, len(self), TEXT_CHUNK_LINES):
+            last = min(first + TEXT_CHUNK_LINES, len(self))
+            chunk = self.lower[offsets[first]:offsets[last] - 1].split('\n')
+            if len(chunk) != last - first:
+                chunk = [self.get_lower_line(i) for i in range(first, last)]
+            yield from chunk
+
 
 class AerojumpLine(object):
-    """ Class for a line in a aerojump buffer """
-    def __init__(self, line, num):
+    """ Class for a line in a aerojump buffer
+
+    The text is kept by an AerojumpText shared by all lines,
+    the line itself only holds the state of the filter
+    """
+    __slots__ = ('text', 'num', 'matches', 'scores', 'runs', 'pattern',
+                 'char_positions', 'filt_index', 'res_line', 'best_score',
+                 'best_index', 'truncated')
+
+    def __init__(self, text, num):
         """ Constructor for the aerojump line class
 
         Parameters:
-            line: the text that the line contains
-            num: the line number in the buffer that the line comes from
+            text: the AerojumpText that the line is a part of
+            num: the line number in the buffer, i.e. the line
+                 is line num - 1 of text
 
         Returns:
             Aerojump line object
         """
-        # Raw text
-        self.raw = line
-        self.raw_lower = line.lower()
+        # All lines
+        self.text = text
         # Line number
         self.num = num
-        # Matches in this line
-        self.matches = []
+        # Matches in this line and their scores
+        self.matches = _NO_MATCHES
+        self.scores = _NO_MATCHES
+        # Score and index of the first of the best matches
+        self.best_score = 0
+        self.best_index = 0
+        # True when a limit stopped the matches from being found,
+        # i.e. there might be more matches
+        self.truncated = False
+        # Highlight ranges of the matches
+        self.runs = _NO_MATCHES
+        # Pattern that the matches belong to
+        self.pattern = ''
+        # Positions of each character in raw_lower, built on demand
+        self.char_positions = None
+
+    @property
+    def raw(self):
+        """ Raw text """
+        return self.text.get_line(self.num - 1)
+
+    @property
+    def raw_lower(self):
+        """ Lowercase text """
+        return self.text.get_lower_line(self.num - 1)
 
     def _score_matches(self, matches, pat_len):
         """ Scores the matches depending on how
@@ -43,29 +801,59 @@ class AerojumpLine(object):
             pat_len: Total length of the pattern that has been matched
 
         Returns:
-            sorted_matches: List of scored matches
+            runs: Merged runs of adjacent characters of all matches
         """
 
-        sorted_matches = []
-        self.scores = []
+        runs = []
+        self.scores = array('d')
         for m in matches:
-            i = 0
-            score = 1
-            while i < len(m):
-                c_match = [m[i]]
-                while i < len(m) - 1 and m[i+1] - m[i] == 1:
-                    c_match.append(m[i+1])
-                    score += 1
-                    i += 1
-                i += 1
-                if c_match not in sorted_matches:
-                    sorted_matches.append(c_match)
+            match_runs = _get_runs(m)
+            runs.extend(match_runs)
+            # Each character adjacent to the previous one adds to the score
+            score = 1 + len(m) - len(match_runs)
             self.scores.append(score/pat_len)
-        return sorted_matches
+        self.runs = _merge_runs(runs)
+        if len(self.scores) > 0:
+            self.best_score = max(self.scores)
+            self.best_index = self.scores.index(self.best_score)
+        else:
+            self.best_score = 0
+            self.best_index = 0
+        return self.runs
+
+    def _get_char_positions(self, c):
+        """ Returns the positions of a character in the line
+
+        The positions are indexed the first time a character is asked for
+
+        Parameters:
+            c: Character to look up
+
+        Returns:
+            Sorted list of the positions of c in raw_lower
+        """
+        if self.char_positions is None:
+            self.char_positions = {}
+        positions = self.char_positions.get(c)
+        if positions is None:
+            # Searched for in the shared text, no copy of the line is made
+            lower = self.text.lower
+            start = self.text.lower_offsets[self.num - 1]
+            end = self.text.lower_offsets[self.num] - 1
+            positions = array('I')
+            i = lower.find(c, start, end)
+            while i != -1:
+                positions.append(i - start)
+                i = lower.find(c, i + 1, end)
+            self.char_positions[c] = positions
+        return positions
 
     def _match_from(self, matches, pattern, pat_index, word_index):
-        """ Tries to match character at pattern[pat_index]
-            from left to right recursively
+        """ Tries to match the characters from pattern[pat_index]
+            and onwards from left to right
+
+        Each character is matched at its first position at or after
+        the position following the previous match
 
         Parameters:
             matches: List of matches
@@ -76,46 +864,119 @@ class AerojumpLine(object):
         Returns:
             Wether or not a full match of the pattern has been accomplished
         """
-        for i in range(word_index, len(self.raw)):
-            if self.raw_lower[i] == pattern[pat_index]:
-                matches.append(i+1)
-                next_pat_index = pat_index + 1
-                next_word_index = i + 1
-                # Final match in the pattern
-                if next_pat_index == len(pattern):
-                    return True
-                # More characters to process
-                elif next_word_index < len(self.raw_lower):
-                    # Recursion :)
-                    return self._match_from(
-                            matches, pattern, next_pat_index, next_word_index)
-                # No more characters left to process but pattern is complete
-                else:
-                    return False
-        return False
-
-    def filter(self, pattern):
-        """ Applies filter to the line
+        for c in pattern[pat_index:]:
+            positions = self._get_char_positions(c)
+            i = bisect_left(positions, word_index)
+            if i == len(positions):
+                return False
+            matches.append(positions[i] + 1)
+            word_index = positions[i] + 1
+        return True
+
+    def _extend_matches(self, pattern):
+        """ Extends the matches of a previous pattern which
+            is a prefix of the new pattern
+
+        Each match continues from the position where its last
+        character matched, the same way _match_from would have
 
         Parameters:
             pattern: Filter pattern
 
+        Returns:
+            List of the matches that are still complete
+        """
+        extended = []
+        pat_index = len(self.pattern)
+        for m in self.matches:
+            # Copy since the old matches might be cached
+            m = m[:]
+            # Positions are 1-indexed, i.e. continue after m[-1]-1
+            if self._match_from(m, pattern, pat_index, m[-1]):
+                extended.append(m)
+        return extended
+
+    def is_subsequence(self, pattern):
+        """ Fast test of whether the pattern can match the line at all
+
+        Parameters:
+            pattern: Filter pattern
+
+        Returns:
+            True if the characters of the pattern appear in order
+        """
+        lower = self.text.lower
+        pos = self.text.lower_offsets[self.num - 1]
+        end = self.text.lower_offsets[self.num] - 1
+        for c in pattern:
+            pos = lower.find(c, pos, end) + 1
+            if pos == 0:
+                return False
+        return True
+
+    def clear(self, pattern=''):
+        """ Removes all matches of the line
+
+        Parameters:
+            pattern: Filter pattern that is known to have no matches
+
+        Returns:
+            n/a
+        """
+        self.matches = _NO_MATCHES
+        self.scores = _NO_MATCHES
+        self.runs = _NO_MATCHES
+        self.best_score = 0
+        self.best_index = 0
+        self.truncated = False
+        self.pattern = pattern
+
+    def filter(self, pattern, max_matches=0):
+        """ Applies filter to the line
+
+        Parameters:
+            pattern:     Filter pattern
+            max_matches: Max number of matches to find, the rest
+                         are left to find_more_matches, 0 for no limit
+
         Returns:
             n/a
         """
+        if self.pattern != '' and pattern.startswith(self.pattern):
+            # Continue from the matches of the previous pattern
+            num_matches = len(self.matches)
+            self.matches = self._extend_matches(pattern)
+            self.pattern = pattern
+            self._score_matches(self.matches, len(pattern))
+            if len(self.matches) < num_matches:
+                # The later start positions can't match either
+                self.truncated = False
+            elif self.truncated and (max_matches <= 0 or
+                                     len(self.matches) < max_matches):
+                # Find the matches that the limit left out
+                self.find_more_matches(max(max_matches - num_matches, 0))
+            return
+
         # Reset the matches
-        self.matches = []
+        self.clear(pattern)
         if pattern == '':
             # Can't filter empty pattern
             return
 
-        for i in range(0, len(self.raw_lower)):
+        matches = []
+        for i in self._get_char_positions(pattern[0]):
+            if max_matches > 0 and len(matches) == max_matches:
+                self.truncated = True
+                break
             # Reset the proposed matches
-            proposed_matches = []
-            # Start with last pattern c and last char of raw
-            if self.raw_lower[i] == pattern[0]:
-                if self._match_from(proposed_matches, pattern, 0, i):
-                    self.matches.append(proposed_matches)
+            proposed_matches = array('I')
+            if not self._match_from(proposed_matches, pattern, 0, i):
+                # Later start positions can't match either
+                break
+            matches.append(proposed_matches)
+        if matches == []:
+            return
+        self.matches = matches
 
         # 1.0 equals full match, thereafter fuzzy partials
         self._score_matches(self.matches, len(pattern))
@@ -124,18 +985,247 @@ class AerojumpLine(object):
         # matches[:] = sorted_matches[:]
         # matches = matches.sort(key=len, reverse=True)
 
+    def find_more_matches(self, max_matches=0):
+        """ Finds the matches that start after the last match found,
+            the matches are found in the order of their first position
+
+        The best match is chosen among all matches found so far
+
+        Parameters:
+            max_matches: Max number of matches to add, 0 for no limit
+
+        Returns:
+            True if more matches were found
+        """
+        if self.matches == []:
+            return False
+        pattern = self.pattern
+        positions = self._get_char_positions(pattern[0])
+        # Positions are 1-indexed, i.e. start after matches[-1][0]-1
+        first = bisect_left(positions, self.matches[-1][0])
+        # Copy since the old matches might be cached
+        matches = self.matches[:]
+        end = len(matches) + max_matches if max_matches > 0 else None
+        self.truncated = False
+        for i in islice(positions, first, None):
+            if len(matches) == end:
+                self.truncated = True
+                break
+            proposed_matches = array('I')
+            if not self._match_from(proposed_matches, pattern, 0, i):
+                # Later start positions can't match either
+                break
+            matches.append(proposed_matches)
+        if len(matches) == len(self.matches):
+            return False
+        self.matches = matches
+        self._score_matches(self.matches, len(pattern))
+        return True
+
+    def limit_matches(self, max_matches):
+        """ Drops the matches past the first max_matches, they are
+            left to find_more_matches
+
+        Parameters:
+            max_matches: Max number of matches to keep, 0 for no limit
+
+        Returns:
+            n/a
+        """
+        if 0 < max_matches < len(self.matches):
+            self.matches = self.matches[:max_matches]
+            self.truncated = True
+            self._score_matches(self.matches, len(self.pattern))
+
+
+class AerojumpLines(object):
+    """ The lines of an AerojumpText as a sequence of AerojumpLine
+
+    The AerojumpLine of a line is only made the first time the line
+    is asked for, i.e. for the candidates of a filter and its hits,
+    and is kept since it holds the state of the filter
+    """
+    def __init__(self, text):
+        """ Constructor for the aerojump lines class
+
+        Parameters:
+            text: the AerojumpText of the lines
+
+        Returns:
+            Aerojump lines object
+        """
+        self.text = text
+        # Index -> AerojumpLine of the lines asked for so far
+        self.views = {}
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        line = self.views.get(index)
+        if line is None:
+            if not 0 <= index < len(self):
+                raise IndexError('line index out of range')
+            line = AerojumpLine(self.text, index + 1)
+            self.views[index] = line
+        return line
+
+    def replace_lines(self, changes):
+        """ Moves the lines after replaced ranges of lines into place,
+            the text is replaced by AerojumpText.replace_lines
+
+        Parameters:
+            changes: List of (first, last, lines) sorted by line, each
+                     replaces the lines [first, last) with lines
+
+        Returns:
+            n/a
+        """
+        firsts = [first for first, _, _ in changes]
+        # Shift of the lines after each change
+        shifts = list(accumulate(len(lines) - (last - first)
+                                 for first, last, lines in changes))
+        views = {}
+        for index, line in self.views.items():
+            i = bisect_right(firsts, index) - 1
+            if i < 0:
+                views[index] = line
+            elif index >= changes[i][1]:
+                line.num += shifts[i]
+                views[index + shifts[i]] = line
+        self.views = views
+
+
+class AerojumpSnapshot(object):
+    """ The lines of a buffer and the indexes over them
+
+    A snapshot can be shared by later sessions as long as the buffer
+    is unchanged, the state that the lines keep only depends on the
+    text and the pattern that was filtered
+    """
+    def __init__(self, lines):
+        """ Constructor for the aerojump snapshot class
+
+        Parameters:
+            lines:      array of the lines of a buffer
+
+        Returns:
+            Aerojump snapshot object
+        """
+        self.text = AerojumpText(lines)
+        self.lines = AerojumpLines(self.text)
+
+        # Bit masks of the lines containing a character
+        self.char_masks = {}
+
+        # Vectorized index of the lines, built on demand
+        self.numpy_index = None
+
+    def get_size(self):
+        """ Estimates the memory used by the snapshot
+
+        Parameters:
+            n/a
+
+        Returns:
+            Size in bytes
+        """
+        size = sys.getsizeof(self.text.text) + sys.getsizeof(self.text.offsets)
+        if self.text.lower is not self.text.text:
+            size += sys.getsizeof(self.text.lower)
+        if self.text.lower_offsets is not self.text.offsets:
+            size += sys.getsizeof(self.text.lower_offsets)
+        # Only the lines asked for have an AerojumpLine
+        views = self.lines.views
+        size += sys.getsizeof(views)
+        if views:
+            line = next(iter(views.values()))
+            size += len(views) * (
+                    sys.getsizeof(line) + sys.getsizeof(line.num))
+        # The masks and the index grow with the characters searched for
+        size += sys.getsizeof(self.char_masks) + sum(
+                sys.getsizeof(mask) for mask in self.char_masks.values())
+        if self.numpy_index is not None:
+            size += self.numpy_index.get_size()
+        return size
+
+    def release(self):
+        """ Drops what the sessions have left in the snapshot, i.e.
+            the lines with their matches and the numpy index, so that
+            get_size accounts for all of it again
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        self.lines.views = {}
+        self.numpy_index = None
+
+    def update(self, changes):
+        """ Applies the changes made to the buffer since the snapshot
+
+        The changes are merged first so that the text is only rebuilt
+        once, the lines asked for so far are renumbered and the masks
+        are shifted into place
+
+        Parameters:
+            changes: List of (first, last, lines) in the order they
+                     were made, each replaces the lines [first, last)
+                     of the buffer as it was after the previous one,
+                     last is -1 for the end of the buffer
+
+        Returns:
+            n/a
+        """
+        if changes == []:
+            return
+        changes = _merge_changes(changes, len(self.lines))
+        self.text.replace_lines(changes)
+        self.lines.replace_lines(changes)
+
+        for c, mask in self.char_masks.items():
+            new_mask = 0
+            pos = 0
+            prev = 0
+            for first, last, lines in changes:
+                kept = first - prev
+                new_mask |= ((mask >> prev) & ((1 << kept) - 1)) << pos
+                pos += kept
+                for i, l in enumerate(lines):
+                    if c in l.lower():
+                        new_mask |= 1 << (pos + i)
+                pos += len(lines)
+                prev = last
+            self.char_masks[c] = new_mask | ((mask >> prev) << pos)
+
+        # Rebuilt on demand
+        self.numpy_index = None
+
 
 class Aerojump(object):
     """ The main class of aerojump """
+    # Filter the visible lines before the rest of the buffer
+    progressive = True
+    # Rows of the drawn buffer are the line numbers, i.e.
+    # highlights can be limited to the lines in view
+    scoped_highlights = True
+
     def __init__(
             self, settings, lines, lin_nums, cursor_pos, top_line, num_lines):
         """ Constructor for the aerojump class
 
         Parameters:
             settings:   dict of settings
-            lines:      array of the lines of a buffer
-            lin_nums:   array of the lin_nums for
-                        each line in 'line'
+            lines:      array of the lines of a buffer or
+                        an AerojumpSnapshot of them
+            lin_nums:   not used, the lines are numbered
+                        from 1 in the order of 'lines'
             cursor_pos: cursor position when plugin is
                         summoned
             top_line:   top-most line visible in the editor
@@ -145,7 +1235,8 @@ class Aerojump(object):
         Returns:
             an Aerojump object
         """
-        self.settings = settings
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings)
         self.log_str = []
 
         # Store intial cursor/windows potisioning
@@ -154,14 +1245,88 @@ class Aerojump(object):
         self.num_lines = num_lines
 
         self.filter_string = ''
-        self.lines = []
-        for i in range(0, len(lines)):
-            self.lines.append(AerojumpLine(lines[i], lin_nums[i]))
+        if isinstance(lines, AerojumpSnapshot):
+            self.snapshot = lines
+        else:
+            self.snapshot = AerojumpSnapshot(lines)
+        self.text = self.snapshot.text
+        self.lines = self.snapshot.lines
+
+        # Hits of the previous filter, a longer filter can only
+        # match a subset of these lines
+        self.narrow_string = ''
+        self.narrow_lines = []
+
+        # Lines that are left to filter by filter_pending
+        self.pending_before = []
+        self.pending_after = []
+        # Matches that the current filter may still find, None for
+        # no limit
+        self.matches_left = None
+
+        # Bit masks of the lines containing a character
+        self.char_masks = self.snapshot.char_masks
+
+        # Vectorized index of the lines, built on demand
+        self.use_numpy = self.settings['engine'] == 'numpy'
+        if self.use_numpy and numpy is None:
+            self._log('numpy is not available, using the python engine')
+            self.use_numpy = False
+
+        # Worker processes, started when a large filter comes along
+        self.pool = None
+
+        # Results of recent filters
+        self.filter_cache = AerojumpCache(
+                self.settings['cache_entries'], self.settings['cache_size'])
 
         # Reset indices
         self.cursor_line_index = 0
         self.cursor_match_index = 0
         self.has_filter_results = False
+        self.highlights = []
+        self.cursor_highlights = []
+
+        # What the drawn buffer shows, None for the original lines
+        self.frame = None
+        # True when the lines to draw have changed without a new
+        # filter, i.e. the cursor moves need a draw
+        self.frame_outdated = False
+
+        # Lines in view and the lines that highlights were made for
+        self.viewport = None
+        self.highlight_range = None
+        if self.scoped_highlights and self.settings['viewport_highlights']:
+            self.viewport = (top_line[0], top_line[0] + num_lines)
+
+    def close(self):
+        """ Releases the resources of the session
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        # The lines might be kept for a later session, the matches are
+        # kept for resuming until the next session releases them but
+        # the character positions can go
+        for l in self.lines.views.values():
+            l.char_positions = None
+
+    def get_lines(self):
+        """ Gets the text of all lines
+
+        Parameters:
+            n/a
+
+        Returns:
+            List of strings
+        """
+        return self.text.get_lines()
 
     def get_log(self):
         """ Fetch the current log
@@ -184,19 +1349,70 @@ class Aerojump(object):
             True if we still have filter results otherwise false
         """
         self.filter_string = filter_string
-        self.filtered_lines = self._get_filtered_lines(
-                filter_string, self.lines)
+        self.filtered_lines = self._filter_lines(filter_string)
         self.has_filter_results = len(self.filtered_lines) > 0
 
         if self.has_filter_results:
             cursor_indices = self._set_cursor_to_best_match()
             self.cursor_line_index = cursor_indices[0]
             self.cursor_match_index = cursor_indices[1]
+            self._follow_cursor()
             self._update_highlights()
             return True
         else:
             return False
 
+    def has_pending(self):
+        """ Checks if apply_filter left lines to filter
+
+        Parameters:
+            n/a
+
+        Returns:
+            True if filter_pending shall be called
+        """
+        return self.pending_before != [] or self.pending_after != []
+
+    def filter_pending(self):
+        """ Filters the next chunk of the lines left by apply_filter
+
+        The lines below the visible ones are filtered first and
+        thereafter the lines above them, the hits are merged into
+        filtered_lines
+
+        Parameters:
+            n/a
+
+        Returns:
+            True if there still are lines left to filter
+        """
+        if not self.has_pending():
+            return False
+        chunk = self.settings['progressive_lines']
+        if self.settings['parallel_workers'] > 0:
+            # Chunks smaller than this would never reach the workers
+            chunk = max(chunk, self.settings['parallel_min_lines'])
+        if self.pending_after != []:
+            lines = self.pending_after[:chunk]
+            self.pending_after = self.pending_after[chunk:]
+            hits = self._get_filtered_lines(self.filter_string, lines)
+            self.filtered_lines.extend(hits)
+        else:
+            lines = self.pending_before[-chunk:]
+            self.pending_before = self.pending_before[:-chunk]
+            hits = self._get_filtered_lines(self.filter_string, lines)
+            self.filtered_lines[0:0] = hits
+            self.cursor_line_index += len(hits)
+        self._index_filtered_lines(self.filtered_lines)
+
+        if not self.has_pending():
+            self.narrow_lines = self.filtered_lines[:]
+            self._cache_filtered_lines(
+                    self.filter_string, self.filtered_lines)
+        if hits != []:
+            self._update_highlights()
+        return self.has_pending()
+
     def draw(self):
         """ Draw function of the default mode
 
@@ -207,17 +1423,42 @@ class Aerojump(object):
             n/a
 
         Returns:
-            Dict (lines_to_draw, highlights, cursor_position, top_line):
-                lines_to_draw:   content of the lines that shall be drawn
+            Dict (changes, highlights, cursor_highlights, cursor_position):
+                changes:         (start, end, lines) that shall replace the
+                                 drawn lines [start, end) since the last draw
                 highlights:      highlights that shall be painted in the editor
+                cursor_highlights: highlights of the match under the cursor
                 cursor_position: current cursor position
         """
 
-        lines = list(map(lambda x: x.raw, self.lines))
-        return {'lines':            lines,
+        # The original lines are never replaced
+        return {'changes':          [],
                 'highlights':       self.highlights,
+                'cursor_highlights': self.cursor_highlights,
                 'cursor_position':  self.get_cursor()}
 
+    def get_hidden_ranges(self):
+        """ Gets the lines that the mode hides
+
+        Parameters:
+            n/a
+
+        Returns:
+            List of (first_line, last_line) that are hidden
+        """
+        return []
+
+    def reset_frame(self):
+        """ Tells that the drawn buffer shows the original lines again
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        self.frame = None
+
     def get_cursor(self):
         """ Gets the current cursor position
 
@@ -244,22 +1485,55 @@ class Aerojump(object):
         Returns:
             Tuple containing the current cursor position
         """
-        if not self.has_filter_results:
-            return self.og_cursor_pos
+        if not self.has_filter_results:
+            return self.og_cursor_pos
+
+        line = self.filtered_lines[self.cursor_line_index]
+        return (line.num, line.matches[self.cursor_match_index][0]-1)
+
+    def get_highlights(self):
+        """ Returns the current highlights of the matches
+
+        Parameters:
+            n/a
+
+        Returns:
+            Current state of the highlights
+        """
+        return self.highlights
+
+    def set_viewport(self, first_line, last_line):
+        """ Tells which lines are in view when only the
+            matches around them are highlighted
+
+        Parameters:
+            first_line: first line in view
+            last_line:  last line in view
+
+        Returns:
+            True if the highlights were updated
+        """
+        if self.viewport is None:
+            return False
+        self.viewport = (first_line, last_line)
+        if self._viewport_is_highlighted() or not self.has_filter_results:
+            return False
+        self._update_highlights()
+        return True
 
-        line = self.filtered_lines[self.cursor_line_index]
-        return (line.num, line.matches[self.cursor_match_index][0]-1)
+    def get_cursor_highlights(self):
+        """ Returns the current highlights of the match under the cursor
 
-    def get_highlights(self):
-        """ Returns the current highlights
+        These only change when the cursor moves, they are kept
+        apart so that moving the cursor doesn't redraw all matches
 
         Parameters:
             n/a
 
         Returns:
-            Current state of the highlights
+            Current state of the cursor highlights
         """
-        return self.highlights
+        return self.cursor_highlights
 
     def cursor_line_up(self):
         """ Moves cursor upwards to the next matching line
@@ -278,10 +1552,10 @@ class Aerojump(object):
         self.cursor_line_index -= 1
         if self.cursor_line_index < 0:
             self.cursor_line_index = 0
-        scores = self.filtered_lines[self.cursor_line_index].scores
-        self.cursor_match_index = scores.index(max(scores))
+        line = self.filtered_lines[self.cursor_line_index]
+        self.cursor_match_index = line.best_index
 
-        self._update_highlights()
+        self._cursor_moved()
 
     def cursor_line_down(self):
         """ Moves cursor downward to the next matching line
@@ -300,10 +1574,10 @@ class Aerojump(object):
         self.cursor_line_index += 1
         if self.cursor_line_index >= len(self.filtered_lines):
             self.cursor_line_index = len(self.filtered_lines) - 1
-        scores = self.filtered_lines[self.cursor_line_index].scores
-        self.cursor_match_index = scores.index(max(scores))
+        line = self.filtered_lines[self.cursor_line_index]
+        self.cursor_match_index = line.best_index
 
-        self._update_highlights()
+        self._cursor_moved()
 
     def cursor_match_next(self):
         """ Moves cursor towards the next match
@@ -320,11 +1594,14 @@ class Aerojump(object):
         if not self.has_filter_results:
             return
         self.cursor_match_index += 1
-        matches_len = len(self.filtered_lines[self.cursor_line_index].matches)
-        if self.cursor_match_index >= matches_len:
-            self.cursor_line_down()
-        else:
+        line = self.filtered_lines[self.cursor_line_index]
+        if self.cursor_match_index < len(line.matches):
+            self._cursor_moved()
+        elif line.find_more_matches(self.settings['line_matches']):
+            # The runs of the line have changed too
             self._update_highlights()
+        else:
+            self.cursor_line_down()
 
     def cursor_match_prev(self):
         """ Moves cursor towards the previous match
@@ -346,7 +1623,7 @@ class Aerojump(object):
             matchlen = len(self.filtered_lines[self.cursor_line_index].matches)
             self.cursor_match_index = matchlen - 1
         else:
-            self._update_highlights()
+            self._cursor_moved()
 
     def _log(self, log_str):
         """ Log function for Aerojump
@@ -359,21 +1636,6 @@ class Aerojump(object):
         """
         self.log_str.append(str(log_str))
 
-    def _best_match_index_for(self, line):
-        """ Returns the highest match for line
-
-        Parameters:
-            line: Line that will be checked
-
-        Returns:
-            Index of the best match
-        """
-        ret = 0
-        for i in range(0, len(line.matches)):
-            if line.scores[i] > line.scores[ret]:
-                ret = i
-        return ret
-
     def _best_cursor_in(self, lines):
         """ Returns the best cursor indices among the lines
 
@@ -386,25 +1648,36 @@ class Aerojump(object):
                 match_index: index for the best match of that line
         """
         line = lines[0]
-        s_index = self._best_match_index_for(line)
-        score = line.scores[s_index]
+        score = line.best_score
 
         for l in lines:
-            hyp_s_index = self._best_match_index_for(l)
             # Larger score
             if (
-                (l.scores[hyp_s_index] > score) or
+                (l.best_score > score) or
                 (
-                    (l.scores[hyp_s_index] == score) and  # Same score
+                    (l.best_score == score) and  # Same score
                     (abs(self.og_cursor_pos[0] - l.num) <  \
                         abs(self.og_cursor_pos[0]-line.num))
                     # But closer to the original cursor position
                 )
             ):
-                score = l.scores[hyp_s_index]
-                s_index = hyp_s_index
+                score = l.best_score
                 line = l
-        return(line.filt_index, s_index)
+        return(line.filt_index, line.best_index)
+
+    def _get_visible_range(self):
+        """ Returns the range of lines that were visible
+            when aerojump was summoned
+
+        Parameters:
+            n/a
+
+        Returns:
+            Tuple containing (first_line, last_line)
+        """
+        visible_start = self.og_top_line[0]
+        visible_end = visible_start + self.num_lines  # Might need to add -1?
+        return (visible_start, visible_end)
 
     def _set_cursor_to_best_match(self):
         """ Updates the internal cursor position
@@ -418,20 +1691,87 @@ class Aerojump(object):
                 match_index: index for the best match of that line
         """
         # Get information for the currently visible lines
-        visible_start = self.og_top_line[0]
-        visible_end = visible_start + self.num_lines  # Might need to add -1?
+        visible_start, visible_end = self._get_visible_range()
 
-        # Get visible matches
-        visible_matches = list(filter(
-                lambda l: l.num >= visible_start and l.num <= visible_end,
-                self.filtered_lines
-                ))
+        # Get visible matches, the hits are sorted by line number
+        start = _bisect_lines(self.filtered_lines, visible_start)
+        end = _bisect_lines(self.filtered_lines, visible_end + 1)
+        visible_matches = self.filtered_lines[start:end]
         if visible_matches != []:
             ret = self._best_cursor_in(visible_matches)
         else:
             ret = self._best_cursor_in(self.filtered_lines)
         return ret
 
+    def _viewport_is_highlighted(self):
+        """ Checks if the highlights cover the lines in view
+
+        Parameters:
+            n/a
+
+        Returns:
+            True if the lines in view are highlighted
+        """
+        if self.highlight_range is None:
+            return False
+        return (self.highlight_range[0] <= self.viewport[0] and
+                self.viewport[1] <= self.highlight_range[1])
+
+    def _follow_cursor(self):
+        """ Moves the viewport to the cursor when the cursor is
+            outside of it, like the editor scrolls to the cursor
+
+        Parameters:
+            n/a
+
+        Returns:
+            True if the viewport was moved
+        """
+        if self.viewport is None:
+            return False
+        line = self.filtered_lines[self.cursor_line_index].num
+        if self.viewport[0] <= line <= self.viewport[1]:
+            return False
+        first_line = max(1, line - self.num_lines // 2)
+        self.viewport = (first_line, first_line + self.num_lines)
+        return True
+
+    def _cursor_moved(self):
+        """ Updates the highlights after the cursor has moved
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        if self._follow_cursor() and not self._viewport_is_highlighted():
+            self._update_highlights()
+        else:
+            self._update_cursor_highlights()
+
+    def _get_highlighted_lines(self):
+        """ Returns the filtered lines that shall be highlighted
+
+        Parameters:
+            n/a
+
+        Returns:
+            Tuple containing (lines, first_line, last_line)
+                lines:      filtered lines to highlight
+                first_line: first line of the highlighted range
+                last_line:  last line of the highlighted range
+        """
+        if self.viewport is None:
+            return (self.filtered_lines, 1, len(self.lines))
+        margin = self.settings['viewport_margin']
+        first_line = max(1, self.viewport[0] - margin)
+        last_line = min(len(self.lines), self.viewport[1] + margin)
+        self.highlight_range = (first_line, last_line)
+        start = _bisect_lines(self.filtered_lines, first_line)
+        end = _bisect_lines(self.filtered_lines, last_line + 1)
+        return (self.filtered_lines[start:end], first_line, last_line)
+
     def _update_highlights(self):
         """ Updates the internal highlights
 
@@ -445,21 +1785,250 @@ class Aerojump(object):
             n/a
         """
         highlights = []
+        lines = self._get_highlighted_lines()[0]
         # Match highlights
-        for l in self.filtered_lines:
-            for m in l.matches:
-                for i in m:
-                    highlights.append(('SearchResult', l.num-1, i-1, i))
-        # Cursor highlights
-        line = self.filtered_lines[self.cursor_line_index]
-        matches = line.matches[self.cursor_match_index]
-        for m in matches:
-            highlights.append(('SearchHighlight', line.num-1, m-1, m))
+        for l in lines:
+            for start, end in l.runs:
+                highlights.append(('SearchResult', l.num-1, start, end))
         self.highlights = highlights
+        self._update_cursor_highlights()
+
+    def _update_cursor_highlights(self):
+        """ Updates the internal highlights of the match under the cursor
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        highlights = []
+        line = self.filtered_lines[self.cursor_line_index]
+        match = line.matches[self.cursor_match_index]
+        for start, end in _get_runs(match):
+            highlights.append(('SearchHighlight', line.num-1, start, end))
+        self.cursor_highlights = highlights
+
+    def _filter_lines(self, filter_string):
+        """ Filters the lines of the buffer
+
+        Recent results are restored from the cache and when the
+        filter string extends a previous one only the hits of that
+        filter are filtered again instead of the whole buffer
+
+        Parameters:
+            filter_string:  filter string
+
+        Returns:
+            filtered_lines
+        """
+        self.pending_before = []
+        self.pending_after = []
+        # Shared by all chunks of the filter
+        self.matches_left = self.settings['filter_matches'] or None
+        cached = self.filter_cache.get(filter_string)
+        if cached is not None:
+            filtered_lines = self._restore_filtered_lines(
+                    filter_string, cached)
+        else:
+            lines = self._get_narrowed_lines(filter_string)
+            if lines is not self.narrow_lines:
+                # Lines outside the narrowed set shall have no matches
+                for l in self.narrow_lines:
+                    l.clear()
+            chunk = self.settings['progressive_lines']
+            if self.progressive and 0 < chunk < len(lines):
+                filtered_lines = self._get_visible_filtered_lines(
+                        filter_string, lines)
+            else:
+                filtered_lines = self._get_filtered_lines(
+                        filter_string, lines)
+            if self.has_pending():
+                # The lines left to filter may still match
+                self.narrow_string = filter_string
+                self.narrow_lines = (self.pending_before + filtered_lines +
+                                     self.pending_after)
+                return filtered_lines
+            self._cache_filtered_lines(filter_string, filtered_lines)
+
+        # Keep a copy since modes are allowed to reorder filtered_lines
+        self.narrow_string = filter_string
+        self.narrow_lines = filtered_lines[:]
+        return filtered_lines
+
+    def _get_visible_filtered_lines(self, filter_string, lines):
+        """ Filters the visible lines, leaving the rest
+            of the lines to filter_pending
+
+        When none of the visible lines match all lines are filtered
+        since it's needed to know if the filter has any results
+
+        Parameters:
+            filter_string:  filter string
+            lines:          lines to be filtered, sorted by line number
+
+        Returns:
+            filtered_lines
+        """
+        visible_start, visible_end = self._get_visible_range()
+        start = _bisect_lines(lines, visible_start)
+        end = _bisect_lines(lines, visible_end + 1)
+        filtered_lines = self._get_filtered_lines(
+                filter_string, lines[start:end])
+        if filtered_lines != []:
+            self.pending_before = lines[:start]
+            self.pending_after = lines[end:]
+            return filtered_lines
+
+        filtered_lines = (
+                self._get_filtered_lines(filter_string, lines[:start]) +
+                self._get_filtered_lines(filter_string, lines[end:]))
+        self._index_filtered_lines(filtered_lines)
+        return filtered_lines
+
+    def _index_filtered_lines(self, filtered_lines):
+        """ Updates filt_index of the filtered lines
+
+        Parameters:
+            filtered_lines: lines that matched the filter
+
+        Returns:
+            n/a
+        """
+        for i in range(0, len(filtered_lines)):
+            filtered_lines[i].filt_index = i
+
+    def _get_narrowed_lines(self, filter_string):
+        """ Get the smallest set of lines that can match the filter
+
+        Parameters:
+            filter_string:  filter string
+
+        Returns:
+            Lines that shall be filtered
+        """
+        if (self.narrow_string != '' and
+                filter_string.startswith(self.narrow_string)):
+            return self.narrow_lines
+        # Look for the longest cached prefix of the filter
+        for i in range(len(filter_string) - 1, 0, -1):
+            cached = self.filter_cache.get(filter_string[:i])
+            if cached is not None:
+                return cached[0]
+        return self._get_candidate_lines(filter_string)
+
+    def _get_char_mask(self, c):
+        """ Returns a bit mask of the lines containing a character
+
+        Bit i is set when self.lines[i] contains c, the mask
+        is computed the first time a character is asked for
+
+        Parameters:
+            c: Character to look up
+
+        Returns:
+            Bit mask as an int
+        """
+        mask = self.char_masks.get(c)
+        if mask is None:
+            bits = ''.join(['1' if c in l else '0'
+                            for l in self.text.iter_lower_lines()])
+            mask = int(bits[::-1], 2) if bits != '' else 0
+            self.char_masks[c] = mask
+        return mask
+
+    def _get_candidate_lines(self, filter_string):
+        """ Get the lines that contain every character of the filter
+
+        The masks of all characters are and:ed together which rejects
+        most lines of the buffer without looking at them one by one,
+        the numpy engine also checks that the characters are in order
+
+        Parameters:
+            filter_string:  filter string
+
+        Returns:
+            candidate lines
+        """
+        if filter_string == '':
+            # Can't filter empty pattern
+            return []
+
+        if self.use_numpy:
+            if self.snapshot.numpy_index is None:
+                self.snapshot.numpy_index = AerojumpNumpyIndex(self.text)
+            indices = self.snapshot.numpy_index.get_candidates(filter_string)
+            return [self.lines[i] for i in indices.tolist()]
+
+        mask = -1
+        for c in set(filter_string):
+            mask &= self._get_char_mask(c)
+        if mask == 0:
+            return []
+        # Bit i is character i of the reversed binary string
+        bits = bin(mask)[:1:-1]
+        candidates = []
+        i = bits.find('1')
+        while i != -1:
+            candidates.append(self.lines[i])
+            i = bits.find('1', i + 1)
+        return candidates
+
+    def _cache_filtered_lines(self, filter_string, filtered_lines):
+        """ Stores the result of a filter in the cache
+
+        Parameters:
+            filter_string:  filter string
+            filtered_lines: lines that matched the filter
+
+        Returns:
+            n/a
+        """
+        matches = [l.matches for l in filtered_lines]
+        scores = [l.scores for l in filtered_lines]
+        runs = [l.runs for l in filtered_lines]
+        best_indices = array('I', [l.best_index for l in filtered_lines])
+        truncated = array('b', [l.truncated for l in filtered_lines])
+        size = len(filtered_lines) + sum(
+                len(m) * len(filter_string) for m in matches)
+        self.filter_cache.put(
+                filter_string,
+                (filtered_lines[:], matches, scores, runs, best_indices,
+                 truncated),
+                size)
+
+    def _restore_filtered_lines(self, filter_string, cached):
+        """ Restores the matches of a cached filter result
+
+        Parameters:
+            filter_string:  filter string of the cached result
+            cached:         cached filter result
+
+        Returns:
+            filtered_lines
+        """
+        for l in self.narrow_lines:
+            l.clear()
+        (filtered_lines, matches, scores, runs, best_indices,
+         truncated) = cached
+        for i in range(0, len(filtered_lines)):
+            l = filtered_lines[i]
+            l.matches = matches[i]
+            l.scores = scores[i]
+            l.runs = runs[i]
+            l.best_index = best_indices[i]
+            l.best_score = l.scores[l.best_index]
+            l.truncated = bool(truncated[i])
+            l.pattern = filter_string
+            l.filt_index = i
+        return filtered_lines[:]
 
     def _get_filtered_lines(self, filter_string, lines):
         """ Get filtered lines
 
+        Lines where the characters of the filter don't appear in
+        order are rejected before their matches are enumerated
+
         Parameters:
             filter_string:  filter string
             lines:          lines to be filtered
@@ -467,14 +2036,132 @@ class Aerojump(object):
         Returns:
             filtered_lines
         """
+        if (self.settings['parallel_workers'] > 0 and
+                len(lines) >= self.settings['parallel_min_lines']):
+            filtered_lines = self._get_filtered_lines_parallel(
+                    filter_string, lines)
+            if filtered_lines is not None:
+                return filtered_lines
+
+        start = time.perf_counter()
+        candidates = []
+        for l in lines:
+            if l.is_subsequence(filter_string):
+                candidates.append(l)
+            else:
+                l.clear(filter_string)
+        reject_done = time.perf_counter()
+
         filtered_lines = []
         filt_index = 0
-        for l in lines:
-            l.filter(filter_string)
+        line_matches = self.settings['line_matches']
+        for l in candidates:
+            l.filter(filter_string,
+                     _get_match_limit(line_matches, self.matches_left))
+            if self.matches_left is not None:
+                self.matches_left -= len(l.matches)
             if l.matches != []:
                 l.filt_index = filt_index
                 filtered_lines.append(l)
                 filt_index += 1
+        match_done = time.perf_counter()
+
+        self._log('Filter "%s": %d lines, %d candidates, %d hits, '
+                  'reject %.2f ms, match %.2f ms' % (
+                      filter_string, len(lines), len(candidates),
+                      len(filtered_lines), (reject_done - start) * 1000,
+                      (match_done - reject_done) * 1000))
+        return filtered_lines
+
+    def _get_pool(self):
+        """ Returns the worker processes, starting them if needed
+
+        The workers are kept for the rest of the session and
+        get a copy of the whole buffer when they are started
+
+        Parameters:
+            n/a
+
+        Returns:
+            The process pool or None if it could not be started
+        """
+        if self.pool is None:
+            context = multiprocessing.get_context(_get_start_method())
+            try:
+                self.pool = ProcessPoolExecutor(
+                        max_workers=self.settings['parallel_workers'],
+                        mp_context=context,
+                        initializer=_worker_init,
+                        initargs=(self.text,))
+            except (OSError, ValueError) as e:
+                self._log('Could not start the workers: ' + str(e))
+                self.settings['parallel_workers'] = 0
+        return self.pool
+
+    def _get_filtered_lines_parallel(self, filter_string, lines):
+        """ Get filtered lines using the worker processes
+
+        The lines are split into contiguous shards which are filtered
+        by the workers, the hits are merged back in line order
+
+        Parameters:
+            filter_string:  filter string
+            lines:          lines to be filtered
+
+        Returns:
+            filtered_lines or None if the workers are not available
+        """
+        pool = self._get_pool()
+        if pool is None:
+            return None
+
+        start = time.perf_counter()
+        indices = [l.num - 1 for l in lines]
+        num_shards = self.settings['parallel_workers'] * 2
+        shard_len = -(-len(indices) // num_shards)
+        shards = [indices[i:i + shard_len]
+                  for i in range(0, len(indices), shard_len)]
+        line_matches = self.settings['line_matches']
+        try:
+            results = list(pool.map(
+                _worker_filter, [filter_string] * len(shards), shards,
+                [line_matches] * len(shards)))
+        except (BrokenProcessPool, OSError) as e:
+            # The workers are started by the first map
+            self._log('The workers stopped working: ' + str(e))
+            self.close()
+            self.settings['parallel_workers'] = 0
+            return None
+
+        # Lines that are not hits shall have no matches
+        for l in lines:
+            l.clear(filter_string)
+
+        filtered_lines = []
+        filt_index = 0
+        for hits in results:
+            for i, matches, scores, runs, best_index, truncated in hits:
+                l = self.lines[i]
+                l.matches = matches
+                l.scores = scores
+                l.runs = runs
+                l.best_index = best_index
+                l.best_score = scores[best_index]
+                l.truncated = truncated
+                # Limited in line order like the serial filter
+                l.limit_matches(
+                        _get_match_limit(line_matches, self.matches_left))
+                if self.matches_left is not None:
+                    self.matches_left -= len(l.matches)
+                l.filt_index = filt_index
+                filtered_lines.append(l)
+                filt_index += 1
+
+        self._log('Filter "%s": %d lines, %d shards, %d hits, '
+                  'parallel %.2f ms' % (
+                      filter_string, len(lines), len(shards),
+                      len(filtered_lines),
+                      (time.perf_counter() - start) * 1000))
         return filtered_lines
 
 # Aerojump sub classes (modes)
@@ -492,22 +2179,51 @@ class AerojumpSpace(Aerojump):
             n/a
 
         Returns:
-            Dict (lines_to_draw, highlights, cursor_position, top_line):
-                lines_to_draw:   content of the lines that shall be drawn
+            Dict (changes, highlights, cursor_highlights, cursor_position):
+                changes:         (start, end, lines) that shall replace the
+                                 drawn lines [start, end) since the last draw
                 highlights:      highlights that shall be painted in the editor
+                cursor_highlights: highlights of the match under the cursor
                 cursor_position: current cursor position
         """
 
-        lines = list(map(self._replace_highlights, self.lines))
+        # Only the lines flipped between shown and blank are redrawn
+        shown = set(l.num for l in self.filtered_lines)
+        if self.frame is None:
+            flipped = set(range(1, len(self.lines) + 1)) - shown
+        else:
+            flipped = self.frame ^ shown
+        self.frame = shown
+
+        ranges = _get_num_ranges(sorted(flipped))
+        if len(ranges) > MAX_DRAW_RANGES:
+            ranges = [(ranges[0][0], ranges[-1][1])]
+
+        changes = []
+        for first_num, last_num in ranges:
+            lines = [self._replace_highlights(num, shown)
+                     for num in range(first_num, last_num + 1)]
+            changes.append((first_num - 1, last_num, lines))
 
-        return {'lines':            lines,
+        return {'changes':          changes,
                 'highlights':       self.highlights,
+                'cursor_highlights': self.cursor_highlights,
                 'cursor_position':  self.get_cursor()}
 
-    @staticmethod
-    def _replace_highlights(line):
-        if line.matches != []:
-            return line.raw
+    def get_hidden_ranges(self):
+        """ Gets the lines without hits, these are blank when drawn
+
+        Parameters:
+            n/a
+
+        Returns:
+            List of (first_line, last_line) that are hidden
+        """
+        return _get_gaps(self.filtered_lines, 1, len(self.lines))
+
+    def _replace_highlights(self, num, shown):
+        if num in shown:
+            return self.text.get_line(num - 1)
         else:
             return ' '
 
@@ -527,25 +2243,26 @@ class AerojumpMilk(Aerojump):
             n/a
         """
         highlights = []
+        lines, first_line, last_line = self._get_highlighted_lines()
 
-        for l in self.lines:
-            if l not in self.filtered_lines:
-                highlights.append(("Comment", l.num-1))
+        # The lines without hits are dimmed a range at a time
+        for first_num, last_num in _get_gaps(lines, first_line, last_line):
+            highlights.append(("Comment", (first_num-1, last_num-1)))
         # Match highlights
-        for l in self.filtered_lines:
-            for m in l.matches:
-                for i in m:
-                    highlights.append(('SearchResult', l.num-1, i-1, i))
-        # Cursor highlights
-        line = self.filtered_lines[self.cursor_line_index]
-        matches = line.matches[self.cursor_match_index]
-        for m in matches:
-            highlights.append(('SearchHighlight', line.num-1, m-1, m))
+        for l in lines:
+            for start, end in l.runs:
+                highlights.append(('SearchResult', l.num-1, start, end))
         self.highlights = highlights
+        self._update_cursor_highlights()
 
 
 class AerojumpBolt(Aerojump):
     """ Subclass for the Bolt mode """
+    # Results are sorted by score, i.e. all lines are needed
+    progressive = False
+    # Results are drawn in their own rows
+    scoped_highlights = False
+
     def get_cursor(self):
         """ Gets the current cursor position
 
@@ -564,6 +2281,9 @@ class AerojumpBolt(Aerojump):
     def apply_filter(self, filter_string):
         """ Filtering function
 
+        Only the first page of the best results is ranked and
+        laid out, see _add_page
+
         Parameters:
 
             filter_string: string that will be used as filter
@@ -573,17 +2293,19 @@ class AerojumpBolt(Aerojump):
 
         """
         self.filter_string = filter_string
-        self.filtered_lines = self._get_filtered_lines(
-                filter_string, self.lines)
-        self.has_filter_results = len(self.filtered_lines) > 0
+        self.ranked_lines = self._filter_lines(filter_string)
+        self.has_filter_results = len(self.ranked_lines) > 0
+        self.filtered_lines = []
+        self.result_lines = []
+        self.separator_indices = []
 
         if self.has_filter_results:
-            self.highlights = []
-            self._sort_filtered_lines()
+            self._add_page()
             # Already sorted
             self.cursor_line_index = 0
-            scores = self.filtered_lines[self.cursor_line_index].scores
-            self.cursor_match_index = scores.index(max(scores))
+            line = self.filtered_lines[self.cursor_line_index]
+            self.cursor_match_index = line.best_index
+            self._update_highlights()
             return True
         else:
             return False
@@ -598,53 +2320,127 @@ class AerojumpBolt(Aerojump):
             n/a
 
         Returns:
-            Dict (lines_to_draw, highlights, cursor_position, top_line):
-                lines_to_draw:   content of the lines that shall be drawn
+            Dict (changes, highlights, cursor_highlights, cursor_position):
+                changes:         (start, end, lines) that shall replace the
+                                 drawn lines [start, end) since the last draw
                 highlights:      highlights that shall be painted in the editor
+                cursor_highlights: highlights of the match under the cursor
                 cursor_position: current cursor position
         """
+        lines = self.result_lines
+        if self.frame is None:
+            changes = [(0, len(self.lines), lines)]
+        else:
+            changes = _diff_lines(self.frame, lines)
+        self.frame = lines
+        self.frame_outdated = False
 
-        lines = []
-        line_num = 0
-        self.separator_indices = []
-        for line in self.filtered_lines:
-            # Add separator
-            separator = '----------- Line: ' + str(line.num) + ' '
-            while (len(separator) < 40):
-                separator = separator + '-'
-            lines.append(separator)
-            self.separator_indices.append(line_num)
-            line_num += 1
-
-            # Add lines before
-            lines_before_res = self.settings['bolt_lines_before']
-            for i in range(0, lines_before_res):
-                index = line.num - 1 - lines_before_res + i
-                if index > 0:
-                    lines.append(self.lines[index].raw)
-                    line_num += 1
-
-            lines.append(line.raw)
-            line.res_line = line_num + 1
-
-            # Add lines after
-            lines_after_res = self.settings['bolt_lines_after']
-            for i in range(0, lines_after_res):
-                index = line.num + 1 + i
-                if index < len(self.lines):
-                    lines.append(self.lines[index].raw)
-                    line_num += 1
-            line_num += 1
+        return {'changes':          changes,
+                'highlights':       self.highlights,
+                'cursor_highlights': self.cursor_highlights,
+                'cursor_position':  self.get_cursor()}
 
-        if self.has_filter_results:
+    def cursor_line_down(self):
+        """ Moves cursor downward to the next matching line, the
+            next page of results is added when the cursor is on
+            the last result of the drawn ones
+
+        Call 'get_cursor' to get the new position to get effect
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+
+        """
+        if (self.has_filter_results and
+                self.cursor_line_index == len(self.filtered_lines) - 1 and
+                self._add_page()):
+            super().cursor_line_down()
             self._update_highlights()
+        else:
+            super().cursor_line_down()
 
-        return {'lines':            lines,
-                'highlights':       self.highlights,
-                'cursor_position':  self.get_cursor()}
+    def _add_page(self):
+        """ Ranks and lays out the next page of the results
+
+        Only the best results so far are kept in a heap, which
+        keeps the results of the earlier pages where they are
+
+        Parameters:
+            n/a
+
+        Returns:
+            True if there were more results to add
+        """
+        shown = len(self.filtered_lines)
+        if shown >= len(self.ranked_lines):
+            return False
+        page_size = self.settings['bolt_page_size']
+        if page_size > 0:
+            # Stable like sorting, equal scores keep the line order
+            self.filtered_lines = heapq.nlargest(
+                    shown + page_size, self.ranked_lines,
+                    key=lambda x: x.best_score)
+        else:
+            self.filtered_lines = sorted(
+                    self.ranked_lines, key=lambda x: x.best_score,
+                    reverse=True)
+        self._layout_results()
+        self.frame_outdated = True
+        return True
+
+    def _get_blocks(self):
+        """ Groups the results whose context lines overlap or
+            touch into blocks of consecutive lines
+
+        Parameters:
+            n/a
 
-    def _sort_filtered_lines(self):
-        """ Sorts the filtered lines depending on score
+        Returns:
+            List of [first_line, last_line, results, rank] in the
+            order of the best result of each block, which is first
+            in results
+        """
+        lines_before = max(self.settings['bolt_lines_before'], 0)
+        lines_after = max(self.settings['bolt_lines_after'], 0)
+        # Blocks by rank and the same blocks sorted by their lines
+        blocks = []
+        starts = []
+        sorted_blocks = []
+        for line in self.filtered_lines:
+            first = max(1, line.num - lines_before)
+            last = min(len(self.lines), line.num + lines_after)
+            start = bisect_left(starts, first)
+            if start > 0 and sorted_blocks[start - 1][1] >= first - 1:
+                start -= 1
+            end = start
+            while end < len(starts) and starts[end] <= last + 1:
+                end += 1
+
+            if start == end:
+                block = [first, last, [line], len(blocks)]
+                blocks.append(block)
+            else:
+                # The best block takes over the others
+                block = sorted_blocks[start]
+                for b in sorted_blocks[start:end]:
+                    if b[3] < block[3]:
+                        block = b
+                block[0] = min(first, sorted_blocks[start][0])
+                block[1] = max(last, sorted_blocks[end - 1][1])
+                for b in sorted_blocks[start:end]:
+                    if b is not block:
+                        block[2].extend(b[2])
+                        b[2] = None
+                block[2].append(line)
+            starts[start:end] = [block[0]]
+            sorted_blocks[start:end] = [block]
+        return [b for b in blocks if b[2] is not None]
+
+    def _layout_results(self):
+        """ Lays out the results in blocks with their context lines
 
         Parameters:
             n/a
@@ -652,9 +2448,23 @@ class AerojumpBolt(Aerojump):
         Returns:
             n/a
         """
-        for f in self.filtered_lines:
-            f.best_score = max(f.scores)
-        self.filtered_lines.sort(key=lambda x: x.best_score, reverse=True)
+        lines = []
+        self.separator_indices = []
+        for first, last, results, _ in self._get_blocks():
+            # Add separator
+            separator = '----------- Line: ' + str(results[0].num) + ' '
+            while (len(separator) < 40):
+                separator = separator + '-'
+            self.separator_indices.append(len(lines))
+            lines.append(separator)
+
+            # Rows of the block follow the line numbers
+            offset = len(lines) - first + 1
+            for line in results:
+                line.res_line = line.num + offset
+            lines.extend(self.text.get_line(i)
+                         for i in range(first - 1, last))
+        self.result_lines = lines
 
     def _update_highlights(self):
         """ Updates the internal highlights
@@ -671,15 +2481,26 @@ class AerojumpBolt(Aerojump):
         highlights = []
         # Match highlights
         for l in self.filtered_lines:
-            for m in l.matches:
-                for i in m:
-                    highlights.append(('SearchResult', l.res_line-1, i-1, i))
-        # Cursor highlights
-        line = self.filtered_lines[self.cursor_line_index]
-        matches = line.matches[self.cursor_match_index]
-        for m in matches:
-            highlights.append(('SearchHighlight', line.res_line-1, m-1, m))
+            for start, end in l.runs:
+                highlights.append(('SearchResult', l.res_line-1, start, end))
         # Separators
         for s in self.separator_indices:
             highlights.append(('Comment', s))
         self.highlights = highlights
+        self._update_cursor_highlights()
+
+    def _update_cursor_highlights(self):
+        """ Updates the internal highlights of the match under the cursor
+
+        Parameters:
+            n/a
+
+        Returns:
+            n/a
+        """
+        highlights = []
+        line = self.filtered_lines[self.cursor_line_index]
+        match = line.matches[self.cursor_match_index]
+        for start, end in _get_runs(match):
+            highlights.append(('SearchHighlight', line.res_line-1, start, end))
+        self.cursor_highlights = highlights